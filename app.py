@@ -1,19 +1,41 @@
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request, Depends, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
+from typing import List, Optional
 import wave
-from openai import OpenAI
+from openai import AsyncOpenAI
 from langchain_community.chat_models import ChatOpenAI
-from langchain.chains import LLMChain
 from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import Runnable
 import os
 import time
-from pydub import AudioSegment
-import multiprocessing
+import io
+import tempfile
+import shutil
+import uuid
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+import contextvars
+import logging
+from dataclasses import dataclass
+import httpx
 import json
 import re
+import hashlib
+from collections import OrderedDict
 import imageio_ffmpeg as ffmpeg
+import numpy as np
+import tiktoken
+import functools
+import math
+import random
+import openai
+import sqlite3
+import threading
 # Load the API key
+api_key = os.getenv("OPENAI_API_KEY")
 
 # Differential diagnosis list
 differential_diagnosis = [
@@ -23,139 +45,8 @@ differential_diagnosis = [
     "Respiratory", "Theriogenology", "Toxicology"
 ]
 
-# Maximum duration for audio processing
-max_duration = 120  # 2 minutes
-
-# FastAPI app initialization
-app = FastAPI()
-
-# CORS settings
-origins = [
-    "https://paws.vetinstant.com",
-    "http://localhost:3000",
-]
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-def split_audio_and_translate(audio_path):
-    """
-    Splits audio file into chunks, translates each chunk using OpenAI,
-    and concatenates translations. Handles short audio chunks gracefully.
-    Returns the complete translated text.
-    """
-    with wave.open(audio_path, 'rb') as wav_file:
-        frames = wav_file.getnframes()
-        frame_rate = wav_file.getframerate()
-        total_duration = frames / float(frame_rate)
-
-        if total_duration <= max_duration:
-            # Audio is within limit, translate directly
-            audio_file = open(audio_path, "rb")
-            try:
-                translation = OpenAI(api_key=api_key).audio.translations.create(
-                    model="whisper-1",
-                    file=audio_file
-                )
-                return translation.text
-            except Exception as e:
-                print(f"OpenAI Error during translation: {e}")
-                return ""
-
-        else:
-            # Split audio into chunks and translate each
-            desired_duration = 60  # 1 minute
-            chunk_size = int(desired_duration * frame_rate)
-            translated_text = ""
-            with wave.open(audio_path, 'rb') as wav_file:
-                for i in range(0, frames, chunk_size):
-                    chunk_data = wav_file.readframes(chunk_size)
-                    with wave.open(f"chunk_{i}.wav", 'wb') as chunk_file:
-                        chunk_file.setnchannels(wav_file.getnchannels())
-                        chunk_file.setsampwidth(wav_file.getsampwidth())
-                        chunk_file.setframerate(frame_rate)
-                        chunk_file.writeframes(chunk_data)
-                    try:
-                        chunk_translation = split_audio_and_translate(f"chunk_{i}.wav")
-                        translated_text += chunk_translation
-                    except Exception as e:
-                        print(f"OpenAI Error during chunk translation: {e}")
-                    os.remove(f"chunk_{i}.wav")
-            return translated_text
-
-def process_audio_and_translate(audio_path, result_queue):
-    translation = split_audio_and_translate(audio_path)
-    result_queue.put(translation)
-    
-
-
-@app.get("/")
-async def read_root():
-    return {"message": "Welcome to the SOAP note generator API"}
-
-@app.post("/soap_note/")
-async def create_soap_note(
-    audio_file: UploadFile = File(...),
-    medical_history: str = Form(...)
-):
-    start_time = time.time()
-
-    # Check file extension
-    file_extension = os.path.splitext(audio_file.filename)[1].lower()
-
-    # Save audio file
-    temp_audio_path = "temp_audio.wav"
-    if file_extension == ".mp3":
-        with open("temp_audio.mp3", "wb") as temp_audio:
-            temp_audio.write(await audio_file.read())
-        # Convert MP3 to WAV
-        audio = AudioSegment.from_mp3("temp_audio.mp3")
-        audio.export(temp_audio_path, format="wav")
-        os.remove("temp_audio.mp3")
-
-    elif file_extension == ".webm":
-        # Extract audio from webm using pydub
-        try:
-            audio = AudioSegment.from_file(audio_file.file)
-            audio.export(temp_audio_path, format="wav")
-        except Exception as e:
-            print(f"Error extracting audio from webm: {e}")
-            return {"error": "Failed to process webm file. Please ensure it's a valid webm audio format."}
-
-    else:
-        with open(temp_audio_path, "wb") as temp_audio:
-            temp_audio.write(await audio_file.read())
-
-    audio_process_time = time.time() - start_time
-    print(f"Audio processing time: {audio_process_time} seconds")
-
-    # Translate audio
-    translate_start_time = time.time()
-    result_queue = multiprocessing.Queue()
-    process = multiprocessing.Process(target=process_audio_and_translate, args=(temp_audio_path, result_queue))
-    process.start()
-    process.join()
-    translation = result_queue.get()
-    translate_time = time.time() - translate_start_time
-    print(f"Translation time: {translate_time} seconds")
-
-    # Combine medical history with translated text
-    full_text = f"Medical History: {medical_history}\n\nConversation: {translation}"
-
-    # OpenAI model initialization
-    openai_time = time.time()
-    openai = ChatOpenAI(model_name='gpt-4', api_key=api_key)
-    openai_init_time = time.time() - openai_time
-    print(f"OpenAI model initialization time: {openai_init_time} seconds")
-
-    # Generating SOAP note prompt
-    prompt_time = time.time()
-    conversation_prompt = PromptTemplate.from_template("""
+# SOAP note prompt; any edit changes soap_prompt_version and so invalidates cached notes
+soap_prompt_template = """
     Role:
 
     You are a knowledgeable veterinary assistant responsible for converting a pre-appointment complaint summary and a doctor-patient conversation into a professional SOAP note format.
@@ -310,7 +201,7 @@ async def create_soap_note(
 
     Differential Diagnosis Section:
 
-    Provide the differential diagnosis in the format System-Condition (e.g., Gastrointestinal-Gastroenteritis). Use the System from this list differential_diagnosis}
+    Provide the differential diagnosis in the format System-Condition (e.g., Gastrointestinal-Gastroenteritis). Use the System from this list {differential_diagnosis}
 
     Step 9: Action Items Extraction:
 
@@ -410,6 +301,10 @@ async def create_soap_note(
     Plan: [Plan content here]
     Conclusion: [Conclusion content here]
     Differentialdiagnosis: [Differential Diagnosis content here]
+    Preventive: [Vaccination, Deworming and Flea & Tick treatment items, one per line as Type: Name, DD-MM-YYYY]
+    Prescription: [One block per medication with Name, Duration, Dosage, Frequency and Remarks lines]
+    Dietrecommendations: [Diet recommendations, one per line]
+    Diagnostics: [Diagnostic tests performed or recommended, one per line as Name, DD-MM-YYYY]
 
     Step 13: Final Reminders:
 
@@ -446,55 +341,2510 @@ async def create_soap_note(
     If any of the information is missing for a particular field and cannot be found or inferred, leave that section blank to maintain data integrity.
 
     If medically relevant content is absent in the source: Output a response for the fields stating that: No medically relevant information was provided for each of the content sections
-    """)
-    prompt_generation_time = time.time() - prompt_time
-    print(f"Prompt generation time: {prompt_generation_time} seconds")
+    """
+soap_prompt_version = hashlib.sha256(
+    (soap_prompt_template + json.dumps(differential_diagnosis)).encode()
+).hexdigest()[:16]
 
-    # Generating medical note
-    process_chain_time = time.time()
-    process_conversation_chain = LLMChain(
-        llm=openai, prompt=conversation_prompt
+# Chat model used to write the SOAP note
+soap_model_name = os.getenv("SOAP_MODEL", "gpt-4")
+
+# Token budget for one SOAP call: the model's context window less the tokens kept
+# free for the note itself. Transcripts that don't fit are condensed segment by
+# segment (at most condense_passes times) instead of being truncated.
+soap_context_window = int(os.getenv("SOAP_CONTEXT_WINDOW", 8192))
+soap_completion_tokens = int(os.getenv("SOAP_COMPLETION_TOKENS", 1500))
+soap_prompt_budget = int(os.getenv("SOAP_PROMPT_BUDGET", soap_context_window - soap_completion_tokens))
+condense_segment_tokens = int(os.getenv("CONDENSE_SEGMENT_TOKENS", 2000))
+condense_passes = int(os.getenv("CONDENSE_PASSES", 2))
+
+# Prompt for shrinking one segment of an oversized transcript
+condense_prompt_template = """
+    You are condensing part of a transcript of a veterinary consultation so that a SOAP note can be written from it later.
+
+    Keep every clinically relevant fact: symptoms and their duration, the owner's observations and concerns, examination findings and measurements, assessments, diagnoses, medications with dose, duration and frequency, vaccinations, deworming, flea and tick treatments, diet recommendations, diagnostic tests, dates and follow-up plans. Note who said what where it matters.
+
+    Drop greetings, small talk and repetition. Do not add anything that is not in the transcript. Write plain sentences in no more than {max_words} words.
+
+    Transcript part {part} of {parts}:
+    {segment}
+    """
+
+# Map-reduce mode for long visits: from this many seconds of audio (0 disables it),
+# findings are extracted from each chunk's transcript as soon as it arrives, and the
+# SOAP prompt then runs over the findings instead of the whole transcript
+map_reduce_min_seconds = float(os.getenv("MAP_REDUCE_MIN_SECONDS", 900))
+map_segment_tokens = int(os.getenv("MAP_SEGMENT_TOKENS", 1500))  # for transcripts served from the cache
+
+# Prompt for the per-chunk extraction calls of map-reduce mode
+findings_prompt_template = """
+    You are reading one part of a transcript of a veterinary consultation. The parts are processed separately and your findings will be merged with those of the other parts into a SOAP note.
+
+    List the clinically relevant findings in this part as short bullet points, grouped under these headings, and leave out headings with nothing to report:
+    Complaints and history, Symptoms, Vitals and examination findings, Assessments and diagnoses, Medications (name, dose, duration, frequency, remarks), Vaccinations, deworming, flea and tick treatments (with dates), Diet recommendations, Diagnostic tests (with dates), Plan and follow-up.
+
+    Only report what is said in this part. Do not add anything that is not in the transcript.
+
+    Transcript part {part} of {parts}:
+    {segment}
+    """
+
+# Sections of the note, and the header lines that open them in the model output
+soap_sections = ["Subjective", "Objective", "Assessment", "Plan", "Conclusion", "DifferentialDiagnosis"]
+action_item_sections = ["Preventive", "Prescription", "Dietrecommendations", "Diagnostics"]
+soap_section_names = {name.lower(): name for name in soap_sections + action_item_sections}
+# Headings the prompt itself uses for some sections (Step 9), and close variants
+soap_section_names.update({
+    "preventivemeasures": "Preventive",
+    "preventivecare": "Preventive",
+    "prescriptions": "Prescription",
+    "medications": "Prescription",
+    "dietrecommendation": "Dietrecommendations",
+    "dietaryrecommendations": "Dietrecommendations",
+    "diagnostictests": "Diagnostics",
+    "diagnostictest": "Diagnostics",
+})
+soap_section_header = re.compile(r"^[\s*#-]*([A-Za-z ]+?)[\s*]*:[\s*]*(.*)$")
+
+def section_name(heading):
+    """The note section a heading or JSON key stands for, or None."""
+    return soap_section_names.get(re.sub(r"\s+", "", heading).lower())
+
+# Function-calling schema the model fills in, so the note needs no text parsing
+structured_output = os.getenv("STRUCTURED_OUTPUT", "1") == "1"
+dated_item = {
+    "type": "object",
+    "properties": {
+        "Name": {"type": "string"},
+        "Date": {"type": "string", "description": "Scheduled date in DD-MM-YYYY format, if given"},
+    },
+    "required": ["Name"],
+}
+soap_note_function = {
+    "name": "record_soap_note",
+    "description": "Record the SOAP note and action items extracted from the consultation.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            **{name: {"type": "string"} for name in soap_sections},
+            "Preventive": {
+                "type": "array",
+                "items": {
+                    **dated_item,
+                    "properties": {
+                        "Type": {"type": "string", "enum": ["Vaccination", "Deworming", "Flea and tick treatment"]},
+                        **dated_item["properties"],
+                    },
+                },
+            },
+            "Prescription": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        field: {"type": "string"}
+                        for field in ("Name", "Duration", "Dosage", "Frequency", "Remarks")
+                    },
+                    "required": ["Name"],
+                },
+            },
+            "Dietrecommendations": {"type": "array", "items": {"type": "string"}},
+            "Diagnostics": {"type": "array", "items": dated_item},
+        },
+        "required": soap_sections,
+    },
+}
+
+# Maximum duration for audio processing
+max_duration = 120  # 2 minutes
+
+# Audio is normalised to mono at this rate, then sent to Whisper as Opus at upload_bitrate
+speech_sample_rate = 16000  # Hz, what Whisper resamples to anyway
+upload_bitrate = int(os.getenv("UPLOAD_BITRATE", 24000))  # bits per second
+max_upload_bytes = 25 * 1024 * 1024  # Whisper's upload limit
+
+# Admission limits, checked from the container headers before anything is decoded
+max_recording_bytes = int(os.getenv("MAX_RECORDING_BYTES", 200 * 1024 * 1024))
+max_recording_seconds = float(os.getenv("MAX_RECORDING_SECONDS", 3600))
+min_recording_seconds = float(os.getenv("MIN_RECORDING_SECONDS", 1))
+
+# Long recordings are cut into chunks of about this many seconds of speech,
+# at the pause nearest each boundary within chunk_cut_search seconds
+chunk_duration = 60  # 1 minute
+chunk_cut_search = float(os.getenv("CHUNK_CUT_SEARCH", 10))
+
+# Silence trimming: level below the recording's loud level that counts as
+# silence, silences longer than vad_min_silence are squeezed to vad_keep_silence
+trim_silence = os.getenv("TRIM_SILENCE", "1") == "1"
+vad_window = 0.03  # seconds per energy window
+vad_threshold_db = float(os.getenv("VAD_THRESHOLD_DB", -35))
+vad_min_silence = float(os.getenv("VAD_MIN_SILENCE", 1.0))  # seconds
+vad_keep_silence = float(os.getenv("VAD_KEEP_SILENCE", 0.4))  # seconds
+vad_min_pause = float(os.getenv("VAD_MIN_PAUSE", 0.25))  # shortest pause used as a chunk boundary
+
+# Chunk transcription: parallel requests per recording
+chunk_concurrency = int(os.getenv("CHUNK_CONCURRENCY", 4))
+
+# OpenAI call scheduling, shared by every request and batch item: calls in flight,
+# requests and tokens per minute (our account quotas; 0 disables a limit), retries
+# with jittered exponential backoff, and the circuit breaker that trips after
+# consecutive failures and lets one probe call through after circuit_reset seconds
+whisper_concurrency = int(os.getenv("WHISPER_CONCURRENCY", 16))
+whisper_rpm = int(os.getenv("WHISPER_RPM", 500))
+llm_concurrency = int(os.getenv("LLM_CONCURRENCY", 8))
+llm_rpm = int(os.getenv("LLM_RPM", 500))
+llm_tpm = int(os.getenv("LLM_TPM", 40000))
+openai_attempts = int(os.getenv("OPENAI_ATTEMPTS", 5))
+openai_retry_delay = float(os.getenv("OPENAI_RETRY_DELAY", 1.0))  # seconds, doubled per attempt
+openai_retry_max_delay = float(os.getenv("OPENAI_RETRY_MAX_DELAY", 60))
+circuit_failures = int(os.getenv("CIRCUIT_FAILURES", 5))
+circuit_reset = float(os.getenv("CIRCUIT_RESET", 30))  # seconds
+
+# Batch requests: most recordings per call, and how many are processed at once
+batch_max_items = int(os.getenv("BATCH_MAX_ITEMS", 50))
+batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", 4))
+
+# Shared executor for blocking audio work, bounded so a burst of uploads
+# can't start an unbounded number of ffmpeg decoders
+decode_workers = int(os.getenv("DECODE_WORKERS", os.cpu_count() or 4))
+decode_executor = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="decode")
+decode_semaphore = asyncio.Semaphore(decode_workers)
+
+# Uploads are read, spooled and fed to ffmpeg in blocks of this size
+upload_chunk_size = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))  # 1 MB
+
+# Per-request scratch directories live here. Defaults to the system temp directory;
+# pointing it at a tmpfs such as /dev/shm keeps audio off the disk but holds every
+# spooled upload and decoded WAV in RAM, so size the tmpfs for the job and batch limits
+scratch_root = os.getenv("AUDIO_SCRATCH_DIR") or tempfile.gettempdir()
+
+# State shared between workers (cache entries, job records, rate-limit buckets).
+# "memory" keeps it inside this process; "sqlite" shares it between every worker
+# on the host through a WAL-mode database at state_path.
+state_backend_name = os.getenv("STATE_BACKEND", "memory")
+state_path = os.getenv("STATE_PATH", os.path.join(tempfile.gettempdir(), "soap_note_state.db"))
+state_attempts = int(os.getenv("STATE_ATTEMPTS", 3))  # tries per statement while the database is locked
+
+# Transcription cache: in-memory LRU per worker, plus the shared state with TTL
+transcript_cache_size = int(os.getenv("TRANSCRIPT_CACHE_SIZE", 256))  # entries, 0 disables the cache
+transcript_cache_ttl = float(os.getenv("TRANSCRIPT_CACHE_TTL", 7 * 24 * 3600))  # seconds
+
+# SOAP note cache, keyed on transcript, history, model and prompt version
+note_cache_size = int(os.getenv("NOTE_CACHE_SIZE", 256))  # entries, 0 disables the cache
+note_cache_ttl = float(os.getenv("NOTE_CACHE_TTL", 24 * 3600))  # seconds
+
+# Background SOAP note jobs
+job_workers = int(os.getenv("JOB_WORKERS", 4))
+job_queue_size = int(os.getenv("JOB_QUEUE_SIZE", 32))  # queued jobs before new ones are refused
+job_retry_after = int(os.getenv("JOB_RETRY_AFTER", 30))  # seconds, sent with 503 when overloaded
+job_ttl = float(os.getenv("JOB_TTL", 3600))  # seconds a finished job stays pollable
+
+# Live sessions (/soap_note/live): each holds an ffmpeg decoder for the whole visit, so
+# their number is capped; a client that sends nothing for live_receive_timeout is dropped
+live_max_sessions = int(os.getenv("LIVE_MAX_SESSIONS", 16))
+live_receive_timeout = float(os.getenv("LIVE_RECEIVE_TIMEOUT", 60))  # seconds
+live_sessions = asyncio.Semaphore(live_max_sessions)
+
+# Shared OpenAI connection pool
+openai_max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", 50))
+openai_max_keepalive = int(os.getenv("OPENAI_MAX_KEEPALIVE", 20))
+openai_timeout = float(os.getenv("OPENAI_TIMEOUT", 600))  # seconds
+
+# Request ids and logging; every log line carries the id of the request it belongs to
+request_id_var = contextvars.ContextVar("request_id", default="-")
+# Stage timings of the current HTTP request, returned in its Server-Timing header
+stage_timings_var = contextvars.ContextVar("stage_timings", default=None)
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+logger = logging.getLogger("soap_note")
+if not logger.handlers:
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(message)s"))
+    log_handler.addFilter(RequestIdFilter())
+    logger.addHandler(log_handler)
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    logger.propagate = False
+
+# Prometheus metrics, rendered in the text exposition format on /metrics
+metrics_registry = []
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
     )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        metrics_registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(labels)} {value}"
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}  # labels -> [bucket counts, sum, count]
+        metrics_registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        state = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {bucket_count}"
+            yield f"{self.name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}"
+            yield f"{self.name}_sum{format_labels(labels)} {total}"
+            yield f"{self.name}_count{format_labels(labels)} {count}"
+
+def render_metrics():
+    return "\n".join(line for metric in metrics_registry for line in metric.render()) + "\n"
+
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+http_request_seconds = Histogram("soap_http_request_seconds", "HTTP request latency by route.", latency_buckets)
+stage_seconds = Histogram("soap_stage_seconds", "Latency of each SOAP pipeline stage.", latency_buckets)
+chunk_seconds = Histogram("soap_chunk_transcription_seconds", "Whisper latency per audio chunk.", latency_buckets)
+upload_bytes = Histogram("soap_upload_bytes", "Size of uploaded recordings.", (1e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8))
+chunk_bytes = Histogram("soap_chunk_upload_bytes", "Size of audio chunks sent to Whisper.", (1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 5e6, 2.5e7))
+audio_seconds = Histogram("soap_audio_seconds", "Duration of decoded recordings.", (30, 60, 120, 300, 600, 1200, 1800, 3600))
+chunk_count = Histogram("soap_audio_chunks", "Number of Whisper chunks per recording.", (1, 2, 4, 8, 16, 32, 64))
+silence_removed_seconds = Counter("soap_silence_removed_seconds_total", "Seconds of silence trimmed before transcription.")
+llm_tokens = Histogram("soap_llm_tokens", "Tokens per SOAP call by part of the prompt, and of the completion.", (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+condensed_transcripts = Counter("soap_condensed_transcripts_total", "Transcripts condensed to fit the token budget, by number of passes.")
+cache_requests = Counter("soap_cache_requests_total", "Cache lookups by cache and result.")
+errors_total = Counter("soap_errors_total", "Pipeline failures by stage.")
+openai_errors_total = Counter("soap_openai_errors_total", "Failed OpenAI calls, including retried ones.")
+openai_throttle_seconds = Histogram("soap_openai_throttle_seconds", "Time OpenAI calls waited for rate-limit budget.", latency_buckets)
+circuit_opened_total = Counter("soap_circuit_opened_total", "Times a circuit breaker opened, by upstream.")
+
+@contextmanager
+def timed_stage(stage):
+    """Records the latency of a pipeline stage, and a failure if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        if not isinstance(e, asyncio.CancelledError):
+            errors_total.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        logger.info("stage=%s seconds=%.3f", stage, elapsed)
+        timings = stage_timings_var.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+class RequestIdMiddleware:
+    """
+    Tags each request with an id (the client's X-Request-ID if it looks sane),
+    returns it in the response headers and records the request latency. The
+    pipeline stages finished before the response starts are reported in a
+    Server-Timing header, in milliseconds. WebSocket connections are recorded
+    under their close code (1006 if neither side sent one).
+    """
 
-    data = {"full_text": full_text, "differential_diagnosis": differential_diagnosis}
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        if not re.fullmatch(r"[\w.-]{1,64}", request_id):
+            request_id = uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        timings = []
+        timings_token = stage_timings_var.set(timings)
+        status = [500 if scope["type"] == "http" else 1006]
+
+        async def receive_with_close_code():
+            message = await receive()
+            if message["type"] == "websocket.disconnect":
+                status[0] = message.get("code", 1000)
+            return message
+
+        async def send_with_request_id(message):
+            if message["type"] == "websocket.close":
+                status[0] = message.get("code", 1000)
+            elif message["type"] in ("http.response.start", "websocket.http.response.start"):
+                status[0] = message["status"]
+                headers = [(b"x-request-id", request_id.encode())]
+                if timings:
+                    server_timing = ", ".join(f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in timings)
+                    headers.append((b"server-timing", server_timing.encode()))
+                message["headers"] = list(message.get("headers", [])) + headers
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive_with_close_code, send_with_request_id)
+        finally:
+            route = scope.get("route")
+            http_request_seconds.observe(
+                time.perf_counter() - start,
+                route=getattr(route, "path", "unmatched"),
+                method=scope.get("method", "WEBSOCKET"),
+                status=status[0],
+            )
+            stage_timings_var.reset(timings_token)
+            request_id_var.reset(token)
+
+class Job(BaseModel):
+    id: str
+    status: str = "queued"  # queued, running, done or failed
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+
+class JobQueue:
+    """
+    Bounded queue of SOAP note jobs drained by a fixed pool of worker tasks.
+    Job records live in the shared state, so any worker can answer a status
+    poll; finished jobs stay pollable for job_ttl seconds.
+    """
 
-    medical_note_text = process_conversation_chain.run(data)
-    process_chain_execution_time = time.time() - process_chain_time
-    print(f"Process chain execution time: {process_chain_execution_time} seconds")
-
-    # Post-process the output to ensure correct format
-    def extract_section(text, section):
-        pattern = rf"{section}:(.*?)(?:\n\n|\Z)"
-        match = re.search(pattern, text, re.DOTALL)
-        return match.group(1).strip() if match else ""
-
-    medical_note = {
-        "Subjective": extract_section(medical_note_text, "Subjective"),
-        "Objective": extract_section(medical_note_text, "Objective"),
-        "Assessment": extract_section(medical_note_text, "Assessment"),
-        "Plan": extract_section(medical_note_text, "Plan"),
-        "Conclusion": extract_section(medical_note_text, "Conclusion"),
-        "DifferentialDiagnosis": extract_section(medical_note_text, "DifferentialDiagnosis")
-        # "Preventive": extract_section(medical_note_text, "Preventive")
-        # "Prescription": extract_section(medical_note_text, "Prescription")
-        # "Dietrecommendations": extract_section(medical_note_text, "Dietrecommendations")
-        # "Diagnostics": extract_section(medical_note_text, "Diagnostics")
-            # Preventice: [Vaccination, Deworming and Flea & Tick treatment related content here]
-            # Prescription: [List medications and treatments content here]
-            # Dietrecommendations: [List diet recommendations content here]
-            # Diagnostics: [List diagnostic tests performed or recommended content here]
+    def __init__(self, workers, max_size):
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """
+        Cancels the running jobs and fails the queued ones, so that pollers on
+        other workers see every job finish rather than wait on it forever.
+        """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        while not self.queue.empty():
+            job, _, workdir = self.queue.get_nowait()
+            self._fail_on_shutdown(job)
+            await self._save(job)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def full(self):
+        return self.queue.full()
+
+    async def submit(self, run, workdir):
+        """
+        Queues run, a coroutine function producing the job result. workdir is
+        removed once the job finishes. Raises asyncio.QueueFull at capacity.
+        """
+        job = Job(id=uuid.uuid4().hex, created_at=time.time())
+        self.queue.put_nowait((job, run, workdir))
+        # A worker may pick the job up while it is saved; answer with the queued record
+        queued = job.model_copy()
+        await self._save(queued)
+        return queued
+
+    async def get(self, job_id):
+        record = await state.get("jobs", job_id)
+        return Job(**record) if record is not None else None
+
+    async def _save(self, job):
+        await state.set("jobs", job.id, job.model_dump(), ttl=job_ttl if job.finished_at is not None else None)
+
+    async def _work(self):
+        while True:
+            job, run, workdir = await self.queue.get()
+            request_id_var.set(job.id)
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                await self._save(job)
+                job.result = await run()
+                job.status = "done"
+            except SoapNoteError as e:
+                logger.warning("Job %s failed: %s", job.id, e)
+                job.status = "failed"
+                job.error = e.message
+            except Exception:
+                logger.exception("Job %s failed", job.id)
+                job.status = "failed"
+                job.error = SoapNoteError.message
+            except asyncio.CancelledError:
+                self._fail_on_shutdown(job)
+                await self._save(job)
+                raise
+            finally:
+                if job.finished_at is None:
+                    job.finished_at = time.time()
+                    await self._save(job)
+                shutil.rmtree(workdir, ignore_errors=True)
+                self.queue.task_done()
+
+    def _fail_on_shutdown(self, job):
+        logger.warning("Job %s failed: server shutting down", job.id)
+        job.status = "failed"
+        job.error = "The server restarted before the job finished. Please submit it again."
+        job.finished_at = time.time()
+
+@dataclass
+class Resources:
+    """Long-lived clients and chain built once at startup and shared by all requests."""
+    http_client: httpx.AsyncClient
+    openai_client: AsyncOpenAI
+    llm: ChatOpenAI
+    conversation_prompt: PromptTemplate
+    conversation_chain: Runnable
+    jobs: JobQueue
+
+@asynccontextmanager
+async def lifespan(app):
+    # One keep-alive pool for Whisper and chat calls, so requests reuse TLS connections
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive,
+        ),
+        timeout=openai_timeout,
+    )
+    # Retries are left to the schedulers, which know about our quotas and the circuit breakers
+    openai_client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+    llm = ChatOpenAI(
+        model_name=soap_model_name,
+        api_key=api_key,
+        async_client=openai_client.chat.completions,
+        max_tokens=soap_completion_tokens,
+    )
+    conversation_prompt = PromptTemplate.from_template(soap_prompt_template)
+    jobs = JobQueue(job_workers, job_queue_size)
+    jobs.start()
+    # Load the tokenizer (possibly a download) now rather than inside the first request
+    await run_blocking(template_tokens)
+    app.state.resources = Resources(
+        http_client=http_client,
+        openai_client=openai_client,
+        llm=llm,
+        conversation_prompt=conversation_prompt,
+        conversation_chain=conversation_prompt | (
+            llm.bind(functions=[soap_note_function], function_call={"name": soap_note_function["name"]})
+            if structured_output else llm
+        ),
+        jobs=jobs,
+    )
+    try:
+        yield
+    finally:
+        await jobs.stop()
+        await http_client.aclose()
+        state.close()
+
+def get_resources(request: Request):
+    return request.app.state.resources
+
+# FastAPI app initialization
+app = FastAPI(lifespan=lifespan)
+
+# CORS settings
+origins = [
+    "https://paws.vetinstant.com",
+    "http://localhost:3000",
+]
+
+app.add_middleware(RequestIdMiddleware)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+def report(progress, event, **data):
+    """Forwards a pipeline progress event to the optional progress callback."""
+    if progress is not None:
+        progress(event, data)
+
+async def gather_all(*coroutines):
+    """
+    Runs coroutines concurrently and returns their results in order. Unlike
+    asyncio.gather, the first failure cancels the rest and is re-raised as
+    itself rather than inside an ExceptionGroup.
+    """
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(coroutine) for coroutine in coroutines]
+    except ExceptionGroup as errors:
+        raise errors.exceptions[0]
+    return [task.result() for task in tasks]
+
+async def run_blocking(func, *args):
+    """Runs a blocking call on the decode executor without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(decode_executor, func, *args)
+
+class MemoryStateBackend:
+    """
+    Shared-state backend that keeps everything in this process. Values
+    (JSON-serialisable) are stored under a namespace and key and expire ttl
+    seconds after they were written; buckets hold rate-limit levels. The
+    public methods are coroutines so that backends doing I/O can keep it off
+    the event loop.
+    """
+    shared = False
+
+    def __init__(self):
+        self.entries = {}  # (namespace, key) -> (value, expires_at)
+        self.buckets = {}  # name -> (level, updated)
+        self.writes = 0
+
+    async def get(self, namespace, key):
+        entry = self.entries.get((namespace, key))
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            del self.entries[(namespace, key)]
+            return None
+        return value
+
+    async def set(self, namespace, key, value, ttl=None):
+        self.entries[(namespace, key)] = (value, time.time() + ttl if ttl is not None else None)
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self.purge_expired()
+
+    def purge_expired(self):
+        now = time.time()
+        for entry_key, (_, expires_at) in list(self.entries.items()):
+            if expires_at is not None and expires_at < now:
+                del self.entries[entry_key]
+
+    async def take(self, bucket, amount, rate_per_minute):
+        """
+        Takes amount from a bucket refilled at rate_per_minute and holding at
+        most one minute's worth. Returns 0 on success, otherwise the seconds
+        to wait before the amount could be available (nothing is taken).
+        """
+        now = time.time()
+        level, updated = self.buckets.get(bucket, (rate_per_minute, now))
+        level = min(rate_per_minute, level + max(0, now - updated) * rate_per_minute / 60)
+        if level >= amount:
+            self.buckets[bucket] = (level - amount, now)
+            return 0
+        self.buckets[bucket] = (level, now)
+        return (amount - level) * 60 / rate_per_minute
+
+    async def drain(self, bucket, seconds, rate_per_minute):
+        """Empties a bucket into debt, so nothing can be taken for the next seconds."""
+        now = time.time()
+        level, updated = self.buckets.get(bucket, (rate_per_minute, now))
+        level = min(rate_per_minute, level + max(0, now - updated) * rate_per_minute / 60)
+        self.buckets[bucket] = (min(level, -seconds * rate_per_minute / 60), now)
+
+    def close(self):
+        pass
+
+class SqliteStateBackend(MemoryStateBackend):
+    """
+    Shared-state backend on an SQLite database in WAL mode, so that every
+    worker process on the host sees the same cache entries, job records and
+    rate-limit buckets. Each process opens its own connection (also after a
+    fork) and runs its statements on a thread of its own, so neither a busy
+    decode executor nor a sibling holding the write lock can stall the event
+    loop. Statements that still find the database locked are retried.
+    """
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.executor = None
+        self.pid = None
+        self.executor_pid = None
+        self.writes = 0
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value TEXT, expires_at REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL, updated REAL)")
+
+    def _connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            # Autocommit mode; take() opens its own write transaction
+            self.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.pid = os.getpid()
+        return self.connection
+
+    async def _run(self, func, *args):
+        """Runs func on this process's state thread, retrying while the database is locked."""
+        if self.executor is None or self.executor_pid != os.getpid():
+            # A forked child inherits the executor but not its thread
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+            self.executor_pid = os.getpid()
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, state_attempts + 1):
+            try:
+                return await loop.run_in_executor(self.executor, func, *args)
+            except sqlite3.OperationalError as e:
+                if attempt == state_attempts:
+                    raise
+                logger.warning("State database error (attempt %d/%d): %s", attempt, state_attempts, e)
+                await asyncio.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+    async def get(self, namespace, key):
+        return await self._run(self._get, namespace, key)
+
+    async def set(self, namespace, key, value, ttl=None):
+        await self._run(self._set, namespace, key, value, ttl)
+        self.writes += 1
+        if self.writes % 100 == 0:
+            await self._run(self.purge_expired)
+
+    async def take(self, bucket, amount, rate_per_minute):
+        return await self._run(self._take, bucket, amount, rate_per_minute)
+
+    async def drain(self, bucket, seconds, rate_per_minute):
+        await self._run(self._drain, bucket, seconds, rate_per_minute)
+
+    def _get(self, namespace, key):
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT value FROM entries WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (namespace, key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set(self, namespace, key, value, ttl):
+        with self.lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), time.time() + ttl if ttl is not None else None),
+            )
+
+    def purge_expired(self):
+        with self.lock:
+            self._connect().execute("DELETE FROM entries WHERE expires_at < ?", (time.time(),))
+
+    def _take(self, bucket, amount, rate_per_minute):
+        with self.lock:
+            db = self._connect()
+            # BEGIN IMMEDIATE takes the write lock, so sibling workers can't interleave
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = db.execute("SELECT level, updated FROM buckets WHERE name = ?", (bucket,)).fetchone()
+                level, updated = row if row else (rate_per_minute, now)
+                level = min(rate_per_minute, level + max(0, now - updated) * rate_per_minute / 60)
+                wait = 0 if level >= amount else (amount - level) * 60 / rate_per_minute
+                if not wait:
+                    level -= amount
+                db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (bucket, level, now))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return wait
+
+    def _drain(self, bucket, seconds, rate_per_minute):
+        with self.lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = db.execute("SELECT level, updated FROM buckets WHERE name = ?", (bucket,)).fetchone()
+                level, updated = row if row else (rate_per_minute, now)
+                level = min(rate_per_minute, level + max(0, now - updated) * rate_per_minute / 60)
+                level = min(level, -seconds * rate_per_minute / 60)
+                db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (bucket, level, now))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        if self.executor is not None and self.executor_pid == os.getpid():
+            self.executor.shutdown()
+        if self.connection is not None and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
+        self.executor = None
+
+def create_state_backend(name):
+    if name == "memory":
+        return MemoryStateBackend()
+    if name == "sqlite":
+        return SqliteStateBackend(state_path)
+    raise ValueError(f"Unknown STATE_BACKEND {name!r}; use memory or sqlite")
+
+state = create_state_backend(state_backend_name)
+
+class ResultCache:
+    """
+    Size-bounded LRU cache of JSON-serialisable values in front of the shared
+    state, where entries expire ttl seconds after they were written. With a
+    process-local backend the LRU is the only tier. Hit and miss counts are
+    kept for stats().
+    """
+
+    def __init__(self, name, max_entries, ttl=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            cache_requests.inc(cache=self.name, result="hit")
+            return self.entries[key]
+        if self.max_entries and state.shared:
+            try:
+                value = await state.get(self.name, key)
+            except sqlite3.Error as e:
+                # A cache that can't be read is a miss, not a failed request
+                logger.warning("Shared %s cache unavailable: %s", self.name, e)
+                value = None
+            if value is not None:
+                self._remember(key, value)
+                self.hits += 1
+                self.shared_hits += 1
+                cache_requests.inc(cache=self.name, result="shared_hit")
+                return value
+        self.misses += 1
+        cache_requests.inc(cache=self.name, result="miss")
+        return None
+
+    async def set(self, key, value):
+        self._remember(key, value)
+        if self.max_entries and state.shared:
+            try:
+                await state.set(self.name, key, value, ttl=self.ttl)
+            except sqlite3.Error as e:
+                logger.warning("Shared %s cache unavailable: %s", self.name, e)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
         }
 
-    os.remove(temp_audio_path)
+transcript_cache = ResultCache("transcripts", transcript_cache_size, transcript_cache_ttl)
+note_cache = ResultCache("notes", note_cache_size, note_cache_ttl)
+
+def note_cache_key(full_text):
+    """Digest of everything that determines the generated note."""
+    return hashlib.sha256(f"{soap_model_name}\0{soap_prompt_version}\0{full_text}".encode()).hexdigest()
+
+def hash_audio(audio_path):
+    """
+    Hashes the decoded PCM frames and format of a WAV file, so the same
+    recording maps to the same key whatever container it was uploaded in.
+    """
+    digest = hashlib.sha256()
+    with wave.open(audio_path, 'rb') as wav_file:
+        digest.update(f"{wav_file.getnchannels()}:{wav_file.getsampwidth()}:{wav_file.getframerate()}".encode())
+        while frames := wav_file.readframes(65536):
+            digest.update(frames)
+    return digest.hexdigest()
+
+class SoapNoteError(Exception):
+    """Base class for pipeline failures; message is safe to return to clients."""
+    message = "Failed to generate SOAP note. Please try again."
+
+class AudioDecodeError(SoapNoteError):
+    """Raised when ffmpeg can't decode an upload."""
+
+    def __init__(self, detail, audio_format="audio"):
+        super().__init__(detail)
+        self.message = f"Failed to process {audio_format} file. Please ensure it's a valid {audio_format} audio format."
+
+class AudioRejectedError(SoapNoteError):
+    """Raised when an upload fails admission; status_code is the HTTP status to answer with."""
+
+    def __init__(self, message, status_code=422):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+@dataclass
+class AudioInfo:
+    """What the container headers say about a recording."""
+    size: int  # bytes
+    duration: Optional[float]  # seconds; None if the container doesn't record it
+    channels: int
+    sample_rate: int
+    sample_width: Optional[int] = None  # bytes per sample, for PCM WAV only
+    exact_length: bool = False  # PCM WAV whose header frame count is backed by its data
+
+ffmpeg_duration = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+ffmpeg_audio_stream = re.compile(r"Stream #\S+.*?: Audio: [^,]+, (\d+) Hz, ([^,]+)")
+
+def probe_wav(source):
+    """
+    Reads a PCM WAV header with the wave module from a path or a seekable
+    binary file; None if it isn't one wave can read.
+    """
+    with open(source, "rb") if isinstance(source, str) else nullcontext(source) as f:
+        f.seek(0)
+        try:
+            with wave.open(f, "rb") as wav_file:
+                frame_rate = wav_file.getframerate()
+                channels = wav_file.getnchannels()
+                sample_width = wav_file.getsampwidth()
+                frames = wav_file.getnframes()
+                # wave stops right after the data chunk's header
+                data_start = f.tell()
+        except (wave.Error, EOFError):
+            return None
+        size = f.seek(0, os.SEEK_END)
+    # Streamed WAVs carry a placeholder length (0 or far past the end of the
+    # file); count the frames actually there instead
+    data_frames = max(0, size - data_start) // max(1, channels * sample_width)
+    exact_length = 0 < frames <= data_frames
+    if not exact_length:
+        frames = data_frames
+    return AudioInfo(
+        size, frames / frame_rate if frame_rate else 0.0, channels, frame_rate, sample_width, exact_length
+    )
+
+def parse_channels(layout):
+    """Channel count of an ffmpeg layout such as mono, stereo, 5.1(side) or 3 channels."""
+    layout = layout.split("(")[0].strip()
+    if layout == "mono":
+        return 1
+    if layout == "stereo":
+        return 2
+    if match := re.match(r"(\d+) channels", layout):
+        return int(match.group(1))
+    if re.fullmatch(r"\d+(\.\d+)*", layout):
+        return sum(int(part) for part in layout.split("."))
+    return 0
+
+def upload_fileno(file):
+    """File descriptor of an upload's spooled file, flushed so that a subprocess sees all of it."""
+    fd = file.fileno()  # rolls an upload still held in memory over to disk
+    file.flush()
+    return fd
+
+async def probe_with_ffmpeg(fd, size, audio_format):
+    """
+    Reads duration, channels and sample rate from the banner `ffmpeg -i`
+    prints after parsing the container headers of a recording of size bytes,
+    open as file descriptor fd. No audio is decoded. ffmpeg gets a seekable
+    file rather than a pipe, because that is what it needs to estimate the
+    length of formats such as mp3 that don't record it.
+    """
+    process = await asyncio.create_subprocess_exec(
+        ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-i", f"/dev/fd/{fd}",
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+        pass_fds=(fd,),
+    )
+    try:
+        # ffmpeg always complains about the missing output file, so the exit code says nothing
+        _, stderr = await process.communicate()
+    except BaseException:
+        await kill_process(process)
+        raise
+    banner = stderr.decode(errors="replace")
+    if "Input #0" not in banner:
+        raise AudioRejectedError(AudioDecodeError(banner, audio_format).message)
+    stream = ffmpeg_audio_stream.search(banner)
+    if stream is None:
+        raise AudioRejectedError("The recording has no audio stream.", status_code=415)
+    duration = ffmpeg_duration.search(banner)
+    if duration:
+        hours, minutes, seconds = duration.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return AudioInfo(size, duration, parse_channels(stream.group(2)), int(stream.group(1)))
+
+def check_duration(duration):
+    """Applies the duration limits; raises AudioRejectedError if duration is outside them."""
+    if duration < min_recording_seconds:
+        raise AudioRejectedError("The recording is empty or too short to contain a consultation.")
+    if duration > max_recording_seconds:
+        raise AudioRejectedError(
+            f"The recording is longer than the {max_recording_seconds / 60:.1f} minute limit.",
+            status_code=413,
+        )
+
+def upload_size(audio_file):
+    """Size in bytes of an upload, as received by the server."""
+    if audio_file.size is not None:
+        return audio_file.size
+    return audio_file.file.seek(0, os.SEEK_END)
+
+def too_large_error():
+    return AudioRejectedError(
+        f"The recording is larger than the {max_recording_bytes / (1024 * 1024):.1f} MB limit.",
+        status_code=413,
+    )
+
+async def probe_upload(audio_file):
+    """
+    Pre-flight check of an upload from its size and headers alone, read where
+    the server received it: rejects empty, over-sized, corrupt, silent-container
+    and over-long recordings with AudioRejectedError and returns the AudioInfo
+    for the rest of the pipeline.
+    """
+    size = upload_size(audio_file)
+    if size == 0:
+        raise AudioRejectedError("The recording is empty.")
+    if size > max_recording_bytes:
+        raise too_large_error()
+    file_extension = upload_extension(audio_file)
+    try:
+        info = await run_blocking(probe_wav, audio_file.file) if file_extension == ".wav" else None
+        if info is None:
+            fd = await run_blocking(upload_fileno, audio_file.file)
+            info = await probe_with_ffmpeg(fd, size, file_extension[1:] or "audio")
+    finally:
+        await audio_file.seek(0)
+    # Some recorders (MediaRecorder webm) don't write a duration; it is checked after decoding instead
+    if info.duration is not None:
+        check_duration(info.duration)
+    return info
+
+async def receive_upload(audio_file, path):
+    """
+    Probes an upload, then spools it to path; raises AudioRejectedError if it
+    fails admission, before anything is copied.
+    """
+    info = await probe_upload(audio_file)
+    await spool_upload(audio_file, path)
+    return info
+
+def rejected_error(error):
+    return HTTPException(status_code=error.status_code, detail=error.message)
+
+async def iter_upload(upload):
+    """Yields an upload in fixed-size blocks instead of reading it whole."""
+    while chunk := await upload.read(upload_chunk_size):
+        yield chunk
+
+async def iter_file(path):
+    """Yields a file in fixed-size blocks."""
+    with open(path, "rb") as f:
+        while chunk := f.read(upload_chunk_size):
+            yield chunk
 
-    total_time = time.time() - start_time
-    print(f"Total time taken: {total_time} seconds")
+async def spool_upload(upload, path):
+    """
+    Copies an upload to path block by block; returns the number of bytes
+    written. Raises AudioRejectedError as soon as it exceeds max_recording_bytes.
+    """
+    size = 0
+    with open(path, "wb") as out:
+        async for chunk in iter_upload(upload):
+            size += len(chunk)
+            if size > max_recording_bytes:
+                raise too_large_error()
+            out.write(chunk)
+    return size
+
+async def kill_process(process):
+    """Kills a subprocess that is still running and reaps it."""
+    if process.returncode is None:
+        process.kill()
+        await process.wait()
+
+async def transcode_to_wav(chunks, output_path, audio_format="audio", max_seconds=None):
+    """
+    Pipes an async stream of encoded audio blocks (wav/mp3/webm) through an
+    ffmpeg subprocess and writes it to output_path as mono 16-bit WAV at
+    speech_sample_rate. Only one block is held in memory at a time, whatever
+    the length of the recording. With max_seconds, decoding stops there.
+    """
+    limit = ["-t", str(max_seconds)] if max_seconds is not None else []
+    async with decode_semaphore:
+        process = await asyncio.create_subprocess_exec(
+            ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0", *limit, "-vn", "-ac", "1", "-ar", str(speech_sample_rate),
+            "-c:a", "pcm_s16le", "-f", "wav", "-y", output_path,
+            stdin=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stderr_task = asyncio.create_task(process.stderr.read())
+        try:
+            try:
+                async for chunk in chunks:
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+                process.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                # ffmpeg gave up on the input; its exit code and stderr say why
+                pass
+            returncode = await process.wait()
+            stderr = await stderr_task
+        except BaseException:
+            # Cancelled (client gone, job queue stopping) or failed mid-stream
+            stderr_task.cancel()
+            await kill_process(process)
+            raise
+        if returncode != 0:
+            detail = stderr.decode(errors="replace").strip() or f"ffmpeg exited with {returncode}"
+            raise AudioDecodeError(detail, audio_format)
+
+async def encode_for_upload(wav_bytes):
+    """Encodes an in-memory WAV chunk as low-bitrate Opus in Ogg for upload to Whisper."""
+    async with decode_semaphore:
+        process = await asyncio.create_subprocess_exec(
+            ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+            "-f", "wav", "-i", "pipe:0", "-c:a", "libopus", "-b:a", str(upload_bitrate),
+            "-application", "voip", "-f", "ogg", "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            encoded, stderr = await process.communicate(wav_bytes)
+        except BaseException:
+            await kill_process(process)
+            raise
+    if process.returncode != 0:
+        raise AudioDecodeError(stderr.decode(errors="replace").strip() or f"ffmpeg exited with {process.returncode}")
+    return encoded
+
+class UpstreamUnavailableError(SoapNoteError):
+    """Raised without calling OpenAI while a circuit breaker is open."""
+    message = "The AI service is temporarily unavailable. Please try again shortly."
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} circuit is open")
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """
+    Rate limit of rate_per_minute units, refilled continuously and holding at
+    most one minute's worth. The level lives in the shared state, so the
+    quota holds across all workers. Waiters in this worker are served in
+    arrival order so large requests aren't starved by small ones. A rate of
+    0 means unlimited.
+    """
+
+    def __init__(self, name, rate_per_minute):
+        self.name = name
+        self.capacity = rate_per_minute
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        """Waits until amount units are available and takes them; returns seconds waited."""
+        if self.capacity <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        started = time.monotonic()
+        async with self.lock:
+            while wait := await state.take(self.name, amount, self.capacity):
+                await asyncio.sleep(wait)
+        return time.monotonic() - started
+
+    async def pause(self, seconds):
+        """Holds back every worker's callers for seconds, e.g. after a 429."""
+        if self.capacity > 0:
+            await state.drain(self.name, seconds, self.capacity)
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive outage failures (see
+    is_outage), rejecting calls for
+    reset_timeout seconds, then lets a single probe call through: its success
+    closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def retry_after(self):
+        """Seconds until calls are let through again, 0 if the circuit is closed."""
+        if self.opened_at is None:
+            return 0
+        if self.probing:
+            return self.reset_timeout
+        return max(0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def check(self):
+        """
+        Raises UpstreamUnavailableError unless a call may go ahead now;
+        returns True if that call is the probe.
+        """
+        if self.opened_at is None:
+            return False
+        retry_after = self.retry_after()
+        if retry_after > 0:
+            raise UpstreamUnavailableError(self.name, retry_after)
+        self.probing = True
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Circuit %s closed", self.name)
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logger.warning("Circuit %s opened after %d consecutive failures", self.name, self.failures)
+            circuit_opened_total.inc(upstream=self.name)
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        """Ends a probe that neither succeeded nor failed (cancelled, or a client error)."""
+        self.probing = False
+
+def is_retryable(error):
+    """Rate limits, timeouts, connection errors and 5xx responses are worth retrying."""
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+def is_outage(error):
+    """
+    Timeouts, connection errors and 5xx responses count towards the circuit
+    breaker. Rate limits don't: the upstream is up, we are just over quota.
+    """
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 408 or error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+def retry_after_seconds(error):
+    """Seconds the response asks us to wait (retry-after-ms or Retry-After), else 0."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return 0
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        return float(response.headers.get("retry-after", 0))
+    except ValueError:
+        return 0
+
+def retry_delay(error, attempt):
+    """Full-jitter exponential backoff, but never sooner than the server's Retry-After."""
+    delay = random.uniform(0, min(openai_retry_max_delay, openai_retry_delay * 2 ** (attempt - 1)))
+    return max(delay, retry_after_seconds(error))
+
+class OpenAIScheduler:
+    """
+    Front door for one kind of OpenAI call. Each call waits for request and
+    token budget, runs with at most `concurrency` others, and is retried with
+    backoff on transient errors. A 429 pauses the buckets for its Retry-After,
+    so every caller slows down rather than each one hitting the limit in turn.
+    The circuit breaker fails new calls fast while the upstream keeps failing,
+    instead of piling more work onto it; calls already under way finish their
+    retries.
+    """
 
-    # After saving the temp audio file
-    if os.path.exists("temp_audio.mp3"):
-        print("temp_audio.mp3 created successfully.")
-        print("File size:", os.path.getsize("temp_audio.mp3"), "bytes")
+    def __init__(self, name, concurrency, rpm, tpm=0):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.requests = TokenBucket(f"{name}:requests", rpm)
+        self.tokens = TokenBucket(f"{name}:tokens", tpm)
+        self.breaker = CircuitBreaker(name, circuit_failures, circuit_reset)
+
+    async def call(self, func, tokens=0, label="", retryable=is_retryable):
+        """
+        Awaits func() under the limits; tokens is the call's estimated cost
+        against the tokens-per-minute quota. Raises UpstreamUnavailableError
+        if the circuit is open when the call starts, or func's last error once
+        attempts run out.
+        """
+        probe = self.breaker.check()
+        for attempt in range(1, openai_attempts + 1):
+            try:
+                waited = await self.requests.acquire(1) + await self.tokens.acquire(tokens)
+                openai_throttle_seconds.observe(waited, call=self.name)
+                async with self.semaphore:
+                    result = await func()
+            except Exception as e:
+                openai_errors_total.inc(call=self.name, error=type(e).__name__)
+                if not retryable(e):
+                    if probe:
+                        self.breaker.release()
+                    raise
+                if is_outage(e):
+                    self.breaker.record_failure()
+                elif probe:
+                    self.breaker.release()
+                probe = False
+                if isinstance(e, openai.RateLimitError):
+                    await self.pause(retry_after_seconds(e) or openai_retry_delay)
+                logger.warning("OpenAI error on %s %s (attempt %d/%d): %s", self.name, label, attempt, openai_attempts, e)
+                if attempt == openai_attempts:
+                    raise
+                await asyncio.sleep(retry_delay(e, attempt))
+            except BaseException:
+                if probe:
+                    self.breaker.release()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def pause(self, seconds):
+        await self.requests.pause(seconds)
+        await self.tokens.pause(seconds)
+
+whisper_scheduler = OpenAIScheduler("transcription", whisper_concurrency, whisper_rpm)
+llm_scheduler = OpenAIScheduler("chat", llm_concurrency, llm_rpm, llm_tpm)
+
+class TranscriptionError(SoapNoteError):
+    """Raised when a chunk still fails after all retries."""
+    message = "Failed to transcribe audio. Please try again."
+
+async def translate_audio(client, audio_file):
+    """Sends one audio file (open file or (filename, bytes) tuple) to Whisper."""
+    translation = await client.audio.translations.create(
+        model="whisper-1",
+        file=audio_file
+    )
+    return translation.text
+
+async def translate_with_retry(client, audio_file, label):
+    """Translates audio_file through the Whisper scheduler, which throttles and retries it."""
+    async def attempt():
+        if hasattr(audio_file, "seek"):
+            audio_file.seek(0)
+        return await translate_audio(client, audio_file)
+
+    try:
+        return await whisper_scheduler.call(attempt, label=label)
+    except SoapNoteError:
+        raise
+    except Exception as e:
+        raise TranscriptionError(f"Failed to translate {label}") from e
+
+def window_levels(wav_file, window):
+    """
+    Returns the RMS level in dBFS of every window-frame slice of an open WAV
+    file, mixed down to mono. The file is read in blocks of 1000 windows.
+    """
+    sample_width = wav_file.getsampwidth()
+    channels = wav_file.getnchannels()
+    dtype = {1: np.uint8, 2: "<i2", 4: "<i4"}[sample_width]
+    full_scale = float(2 ** (8 * sample_width - 1))
+    levels = []
+    while block := wav_file.readframes(window * 1000):
+        samples = np.frombuffer(block, dtype=dtype).astype(np.float32)
+        if sample_width == 1:
+            samples -= 128
+        samples = samples.reshape(-1, channels).mean(axis=1) / full_scale
+        # Zero-pad the last partial window
+        samples = np.pad(samples, (0, -len(samples) % window))
+        rms = np.sqrt(np.mean(samples.reshape(-1, window) ** 2, axis=1))
+        levels.append(20 * np.log10(rms + 1e-10))
+    return np.concatenate(levels) if levels else np.zeros(0)
+
+def plan_speech(audio_path):
+    """
+    Energy-based voice activity pass over a WAV file. Windows quieter than
+    vad_threshold_db below the recording's loud (95th percentile) level are
+    silence. Silences longer than vad_min_silence are squeezed down to
+    vad_keep_silence, and pauses of at least vad_min_pause are remembered
+    as places to cut chunks.
+    Returns (frame_rate, frames, kept, pauses): kept is the list of
+    (start, end) frame ranges left after trimming and pauses the frame
+    positions of the pause midpoints.
+    """
+    with wave.open(audio_path, 'rb') as wav_file:
+        frame_rate = wav_file.getframerate()
+        frames = wav_file.getnframes()
+        if not trim_silence or frames == 0 or wav_file.getsampwidth() not in (1, 2, 4):
+            return frame_rate, frames, [(0, frames)] if frames else [], []
+        window = max(1, int(vad_window * frame_rate))
+        levels = window_levels(wav_file, window)
+
+    silent = levels < np.percentile(levels, 95) + vad_threshold_db
+    if silent.all():
+        # Nothing stands out as speech; send the recording as it is
+        return frame_rate, frames, [(0, frames)], []
+
+    # Start/end window indices of each run of silent windows
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], silent.astype(np.int8), [0]))))
+    run_starts = edges[::2] * window
+    run_ends = np.minimum(edges[1::2] * window, frames)
+    run_lengths = run_ends - run_starts
+
+    is_pause = run_lengths >= vad_min_pause * frame_rate
+    pauses = ((run_starts[is_pause] + run_ends[is_pause]) // 2).tolist()
+
+    keep_edge = int(vad_keep_silence * frame_rate / 2)
+    is_long = run_lengths >= vad_min_silence * frame_rate
+    kept = []
+    position = 0
+    for start, end in zip(run_starts[is_long] + keep_edge, run_ends[is_long] - keep_edge):
+        if start > position:
+            kept.append((position, int(start)))
+        position = int(end)
+    if position < frames:
+        kept.append((position, frames))
+    return frame_rate, frames, kept, pauses
+
+def plan_chunks(kept, pauses, frame_rate, duration):
+    """
+    Groups kept frame ranges into chunks holding about duration seconds of
+    audio each, cutting at the pause nearest each boundary when one lies
+    within chunk_cut_search seconds of it.
+    Returns a list of chunks, each a list of (start, end) frame ranges.
+    """
+    target = int(duration * frame_rate)
+    search = int(chunk_cut_search * frame_rate)
+    pauses = np.asarray(pauses, dtype=np.int64)
+    chunks = []
+    ranges = list(kept)
+    while ranges:
+        # Find where this chunk would reach its target length
+        remaining = target
+        boundary = None
+        for start, end in ranges:
+            if end - start >= remaining:
+                boundary = start + remaining
+                break
+            remaining -= end - start
+        if boundary is None:
+            chunks.append(ranges)
+            break
+
+        chunk_start = ranges[0][0]
+        nearby = pauses[(np.abs(pauses - boundary) <= search) & (pauses > chunk_start)]
+        if len(nearby):
+            boundary = int(nearby[np.argmin(np.abs(nearby - boundary))])
+
+        chunk, rest = [], []
+        for start, end in ranges:
+            if start < boundary:
+                chunk.append((start, min(end, boundary)))
+            if end > boundary:
+                rest.append((max(start, boundary), end))
+        chunks.append(chunk)
+        ranges = rest
+    return chunks
+
+def read_wav_ranges(audio_path, ranges):
+    """Reads the given (start, end) frame ranges and joins them into an in-memory WAV file."""
+    buffer = io.BytesIO()
+    with wave.open(audio_path, 'rb') as wav_file, wave.open(buffer, 'wb') as chunk_file:
+        chunk_file.setnchannels(wav_file.getnchannels())
+        chunk_file.setsampwidth(wav_file.getsampwidth())
+        chunk_file.setframerate(wav_file.getframerate())
+        for start, end in ranges:
+            wav_file.setpos(start)
+            chunk_file.writeframes(wav_file.readframes(end - start))
+    return buffer.getvalue()
+
+async def split_audio_and_translate(audio_path, client, progress=None, on_chunk=None):
+    """
+    Trims long silences from the audio, splits it into chunks at pauses,
+    translates the chunks concurrently using OpenAI (at most
+    chunk_concurrency in flight) and joins the translations in their
+    original order. Chunks are built in memory, so nothing is written next
+    to audio_path. progress, if given, is called with ("speech_trimmed", ...)
+    and ("chunk_transcribed", ...) events; on_chunk, if given, with
+    (index, chunk count, translation) as each chunk finishes.
+    Returns the complete translated text; raises TranscriptionError if any
+    chunk can't be translated.
+    """
+    frame_rate, frames, kept, pauses = await run_blocking(plan_speech, audio_path)
+    total_duration = frames / float(frame_rate)
+    speech_duration = sum(end - start for start, end in kept) / float(frame_rate)
+    removed_duration = total_duration - speech_duration
+    logger.info("Removed %.1f of %.1f seconds of silence", removed_duration, total_duration)
+    audio_seconds.observe(total_duration)
+    silence_removed_seconds.inc(removed_duration)
+    report(progress, "speech_trimmed", duration=total_duration, removed=removed_duration)
+    if not kept:
+        return ""
+
+    # Sizes are planned on the compact upload encoding, not on the PCM
+    upload_seconds = max_upload_bytes * 8 / upload_bitrate * 0.9  # headroom for VBR and container overhead
+    if speech_duration <= min(max_duration, upload_seconds):
+        # Audio is within limit, translate it in one go
+        chunks = [kept]
     else:
-        print("Failed to create temp_audio.mp3.")
+        # Split audio into chunks at pauses and translate them in parallel
+        chunks = plan_chunks(kept, pauses, frame_rate, min(chunk_duration, upload_seconds))
+    chunk_count.observe(len(chunks))
+    semaphore = asyncio.Semaphore(chunk_concurrency)
+
+    async def translate_chunk(index, ranges):
+        async with semaphore:
+            chunk = await encode_for_upload(await run_blocking(read_wav_ranges, audio_path, ranges))
+            chunk_bytes.observe(len(chunk))
+            start = time.perf_counter()
+            translation = await translate_with_retry(client, (f"chunk_{index}.ogg", chunk), f"chunk {index}")
+            chunk_seconds.observe(time.perf_counter() - start)
+        report(progress, "chunk_transcribed", index=index, chunks=len(chunks))
+        if on_chunk is not None:
+            on_chunk(index, len(chunks), translation)
+        return translation
+
+    # A failed chunk cancels the others rather than leaving them calling Whisper
+    translations = await gather_all(*(
+        translate_chunk(index, ranges) for index, ranges in enumerate(chunks)
+    ))
+    return " ".join(text.strip() for text in translations if text.strip())
+
+
+async def decode_audio(source_path, file_extension, workdir, audio_info=None):
+    """
+    Normalises a spooled upload to a mono speech-rate WAV file in workdir and
+    returns its path. When audio_info shows the upload is already in that
+    format, with a header whose length can be trusted, it is used as is. A
+    recording whose headers carried no duration is decoded only up to just
+    past the limit, then checked.
+    """
+    if (
+        audio_info is not None and audio_info.exact_length and audio_info.sample_width == 2
+        and audio_info.channels == 1 and audio_info.sample_rate == speech_sample_rate
+    ):
+        return source_path
+    wav_path = os.path.join(workdir, "audio.wav")
+    unknown_duration = audio_info is not None and audio_info.duration is None
+    await transcode_to_wav(
+        iter_file(source_path), wav_path, file_extension[1:] or "audio",
+        max_recording_seconds + 1 if unknown_duration else None,
+    )
+    if unknown_duration:
+        check_duration(probe_wav(wav_path).duration)
+    return wav_path
+
+async def transcribe_audio(audio_path, resources, progress=None, on_chunk=None):
+    """
+    Returns the transcript of a WAV file, reusing the cached one if this audio
+    was seen before (in which case on_chunk is never called).
+    """
+    audio_hash = await run_blocking(hash_audio, audio_path)
+    translation = await transcript_cache.get(audio_hash)
+    if translation is None:
+        translation = await split_audio_and_translate(audio_path, resources.openai_client, progress, on_chunk)
+        await transcript_cache.set(audio_hash, translation)
+        report(progress, "transcribed", cached=False)
+    else:
+        report(progress, "transcribed", cached=True)
+    return translation
+
+class PromptTooLongError(SoapNoteError):
+    """Raised when the input can't be brought under the token budget."""
+    message = "The consultation is too long to summarise. Please shorten the medical history or split the recording."
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer():
+    """
+    tiktoken encoding for the SOAP model, or None if it can't be loaded
+    (tiktoken fetches encodings on first use), in which case counts are
+    estimated at four characters per token.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(soap_model_name)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("Could not load tokenizer, estimating token counts: %s", e)
+        return None
+
+def count_tokens(text):
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return math.ceil(len(text) / 4)
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+@functools.lru_cache(maxsize=None)
+def template_tokens():
+    """Tokens of the SOAP prompt and function schema, which are the same on every call."""
+    prompt = soap_prompt_template.format(full_text="", differential_diagnosis=differential_diagnosis)
+    schema = json.dumps(soap_note_function) if structured_output else ""
+    return count_tokens(prompt) + count_tokens(schema)
+
+def split_segments(text, max_tokens):
+    """Splits text at sentence ends into segments of at most about max_tokens."""
+    segments, current, current_tokens = [], [], 0
+    for sentence in re.split(r"(?<=[.!?])\s+", text.strip()):
+        tokens = count_tokens(sentence)
+        if current and current_tokens + tokens > max_tokens:
+            segments.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(sentence)
+        current_tokens += tokens
+    if current:
+        segments.append(" ".join(current))
+    return segments
+
+async def condense_transcript(translation, target_tokens, resources):
+    """
+    Shrinks translation towards target_tokens by condensing each segment
+    with the chat model, concurrently. Condensed segments are cached like notes.
+    """
+    segments = split_segments(translation, condense_segment_tokens)
+    # Words run at roughly 0.75 per token; leave a margin for the model overshooting
+    max_words = max(50, int(target_tokens / len(segments) * 0.75 * 0.9))
+
+    async def condense(index, segment):
+        prompt = condense_prompt_template.format(
+            max_words=max_words, part=index + 1, parts=len(segments), segment=segment
+        )
+        key = note_cache_key(prompt)
+        condensed = await note_cache.get(key)
+        if condensed is None:
+            message = await llm_scheduler.call(
+                lambda: resources.llm.ainvoke(prompt),
+                tokens=count_tokens(prompt) + soap_completion_tokens,
+                label=f"condense {index + 1}/{len(segments)}",
+            )
+            condensed = message.content.strip()
+            await note_cache.set(key, condensed)
+        return condensed
+
+    return " ".join(await gather_all(*(condense(i, segment) for i, segment in enumerate(segments))))
+
+async def extract_findings(segment, part, parts, resources):
+    """Runs the extraction call for one part of a transcript; results are cached like notes."""
+    prompt = findings_prompt_template.format(part=part, parts=parts, segment=segment)
+    key = note_cache_key(prompt)
+    findings = await note_cache.get(key)
+    if findings is None:
+        message = await llm_scheduler.call(
+            lambda: resources.llm.ainvoke(prompt),
+            tokens=count_tokens(prompt) + soap_completion_tokens,
+            label=f"findings {part}/{parts}",
+        )
+        findings = message.content.strip()
+        await note_cache.set(key, findings)
+    return findings
+
+class FindingsMap:
+    """
+    Map step of map-reduce mode. add() is the on_chunk callback of
+    split_audio_and_translate and starts the extraction for each chunk's
+    transcript as soon as it arrives, so extraction overlaps the rest of the
+    transcription. gather() waits for the outstanding extractions and returns
+    the findings in recording order.
+    """
+
+    def __init__(self, resources, progress=None):
+        self.resources = resources
+        self.progress = progress
+        self.tasks = {}
+
+    def add(self, index, chunks, text):
+        if text.strip():
+            self.tasks[index] = asyncio.create_task(self._extract(text, index + 1, chunks))
+
+    async def _extract(self, segment, part, parts):
+        findings = await extract_findings(segment, part, parts, self.resources)
+        report(self.progress, "findings_extracted", part=part, parts=parts)
+        return findings
+
+    async def gather(self, translation):
+        """
+        Returns the findings text. If no chunk was reported (the transcript came
+        from the cache) translation is split into segments and mapped here.
+        """
+        if not self.tasks:
+            segments = split_segments(translation, map_segment_tokens)
+            for index, segment in enumerate(segments):
+                self.add(index, len(segments), segment)
+        findings = await asyncio.gather(*(self.tasks[index] for index in sorted(self.tasks)))
+        parts = [f"Part {part}:\n{text}" for part, text in enumerate(findings, 1)]
+        return "Findings extracted from each part of the conversation, in order:\n\n" + "\n\n".join(parts)
+
+    async def cancel(self):
+        """Stops the extractions still running and collects the errors of the ones that failed."""
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+async def fit_to_budget(medical_history, translation, resources, progress=None):
+    """
+    Builds the SOAP chain input from the medical history and transcript,
+    condensing the transcript if the whole prompt would exceed
+    soap_prompt_budget. Token counts are recorded in metrics, logged and
+    reported as a ("tokens", {...}) event. Raises PromptTooLongError if the
+    input can't be made to fit.
+    """
+    history_text = f"Medical History: {medical_history}\n\nConversation: "
+    counts = {"template": template_tokens(), "history": count_tokens(history_text)}
+    available = soap_prompt_budget - counts["template"] - counts["history"]
+    if available <= 0:
+        raise PromptTooLongError("medical history leaves no room for the transcript")
+
+    original_tokens = transcript_tokens = count_tokens(translation)
+    passes = 0
+    while transcript_tokens > available:
+        if passes == condense_passes:
+            raise PromptTooLongError(
+                f"transcript is {transcript_tokens} tokens after {passes} condense passes, budget {available}"
+            )
+        report(progress, "condensing", tokens=transcript_tokens, budget=available)
+        translation = await condense_transcript(translation, available, resources)
+        transcript_tokens = count_tokens(translation)
+        passes += 1
+    if passes:
+        condensed_transcripts.inc(passes=passes)
+
+    counts["transcript"] = transcript_tokens
+    counts["total"] = sum(counts.values())
+    for part, tokens in counts.items():
+        llm_tokens.observe(tokens, part=part)
+    logger.info(
+        "prompt_tokens=%d template=%d history=%d transcript=%d original_transcript=%d condense_passes=%d",
+        counts["total"], counts["template"], counts["history"], transcript_tokens, original_tokens, passes,
+    )
+    report(progress, "tokens", budget=soap_prompt_budget, condense_passes=passes, **counts)
+    return history_text + translation
+
+async def write_soap_note(full_text, resources, progress=None):
+    """
+    Runs the SOAP chain on full_text, reusing the cached note if this input
+    was seen before. With a progress callback the model output is streamed
+    and reported as ("token", {"text": ...}) events; a cached note is not
+    model output, so it is reported as a single note_cached event instead.
+    """
+    note_key = note_cache_key(full_text)
+    medical_note_text = await note_cache.get(note_key)
+    if medical_note_text is not None:
+        report(progress, "note_cached")
+        return medical_note_text
+
+    data = {"full_text": full_text, "differential_diagnosis": differential_diagnosis}
+    # Quota cost: the prompt plus the completion tokens the model may use
+    tokens = template_tokens() + count_tokens(full_text) + soap_completion_tokens
+    report(progress, "llm_started")
+    if progress is None:
+        message = await llm_scheduler.call(
+            lambda: resources.conversation_chain.ainvoke(data), tokens=tokens, label="SOAP note"
+        )
+        # Structured output arrives as function-call arguments (a JSON string)
+        function_call = message.additional_kwargs.get("function_call")
+        medical_note_text = function_call["arguments"] if function_call else message.content
+    else:
+        parts = []
+
+        async def stream_note():
+            async for chunk in resources.llm.astream(resources.conversation_prompt.format(**data)):
+                parts.append(chunk.content)
+                report(progress, "token", text=chunk.content)
+
+        # Once tokens have reached the client a retry would repeat them, so only retry before that
+        await llm_scheduler.call(
+            stream_note, tokens=tokens, label="SOAP note", retryable=lambda e: not parts and is_retryable(e)
+        )
+        medical_note_text = "".join(parts)
+    llm_tokens.observe(count_tokens(medical_note_text), part="completion")
+    await note_cache.set(note_key, medical_note_text)
+    return medical_note_text
+
+class SoapSectionParser:
+    """
+    Incremental parser for the model's "Header: content" output. Text can be
+    fed in pieces of any size; each section is returned as soon as the next
+    header (or close()) ends it.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.section = None
+        self.lines = []
+
+    def feed(self, text):
+        """Consumes text and returns the (name, content) sections it completed."""
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        return [section for line in lines if (section := self._consume(line))]
+
+    def close(self):
+        """Flushes buffered text and returns the remaining sections."""
+        done = []
+        if self.buffer:
+            section = self._consume(self.buffer)
+            self.buffer = ""
+            if section:
+                done.append(section)
+        if self.section:
+            done.append(self._finish())
+        return done
+
+    def _consume(self, line):
+        match = soap_section_header.match(line)
+        name = match and section_name(match.group(1))
+        if not name:
+            if self.section:
+                self.lines.append(line)
+            return None
+        finished = self._finish() if self.section else None
+        self.section = name
+        self.lines = [match.group(2)]
+        return finished
+
+    def _finish(self):
+        section = (self.section, "\n".join(self.lines).strip())
+        self.section = None
+        self.lines = []
+        return section
+
+date_pattern = re.compile(r"\b\d{1,2}-\d{1,2}-\d{4}\b")
+empty_item = re.compile(r"^(none|n/?a|not applicable|no .* (provided|mentioned|discussed))\.?$", re.IGNORECASE)
+
+def section_lines(content):
+    """Non-empty lines of a section with list bullets stripped, skipping "None"-style placeholders."""
+    lines = (re.sub(r"^\s*(?:[-*\u2022]|\d+[.)])\s*", "", line).strip() for line in content.splitlines())
+    return [line for line in lines if line and not empty_item.match(line)]
+
+def split_dated(text):
+    """Splits "Name, DD-MM-YYYY" into a {"Name", "Date"} item."""
+    match = date_pattern.search(text)
+    if not match:
+        return {"Name": text.strip(" ,;"), "Date": ""}
+    name = (text[:match.start()] + text[match.end():]).strip(" ,;-")
+    return {"Name": name, "Date": match.group()}
+
+def parse_action_items(name, content):
+    """Turns the free text of an action-item section into the structured items of soap_note_function."""
+    lines = section_lines(content)
+    if name == "Dietrecommendations":
+        return lines
+    if name == "Diagnostics":
+        return [split_dated(line) for line in lines]
+    if name == "Preventive":
+        items = []
+        for line in lines:
+            kind, _, rest = line.partition(":")
+            if not rest:
+                kind, rest = "", kind
+            kind = kind.strip().rstrip("s").replace("&", "and")
+            if kind.lower().startswith("flea"):
+                kind = "Flea and tick treatment"
+            items.append({"Type": kind, **split_dated(rest)})
+        return items
+    # Prescription: blocks of "Field: value" lines, each starting with Name
+    items = []
+    for line in lines:
+        field, _, value = line.partition(":")
+        field = field.strip().capitalize()
+        if field not in ("Name", "Duration", "Dosage", "Frequency", "Remarks") or not value:
+            items.append({"Name": line})
+        elif field == "Name" or not items or field in items[-1]:
+            items.append({field: value.strip()})
+        else:
+            items[-1][field] = value.strip()
+    return [{"Name": "", "Duration": "", "Dosage": "", "Frequency": "", "Remarks": "", **item} for item in items]
+
+def parse_section(name, content):
+    """Parsed value of one section: text for SOAP sections, a list for action items."""
+    return parse_action_items(name, content) if name in action_item_sections else content
+
+def empty_soap_note():
+    return {
+        **{name: "" for name in soap_sections},
+        **{name: [] for name in action_item_sections},
+    }
+
+json_string_field = re.compile(r'"(\w+)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+def load_structured_note(medical_note_text):
+    """
+    Decodes function-call output, or returns None for free text. Malformed
+    JSON (raw newlines in strings, or cut off at the token limit) is logged
+    and its complete string fields are salvaged rather than dropped.
+    """
+    if not medical_note_text.lstrip().startswith("{"):
+        return None
+    try:
+        return json.loads(medical_note_text, strict=False)
+    except ValueError as e:
+        logger.warning("Malformed function-call JSON in SOAP note (%s); salvaging its string fields", e)
+    salvaged = {}
+    for key, value in json_string_field.findall(medical_note_text):
+        try:
+            salvaged[key] = json.loads(f'"{value}"', strict=False)
+        except ValueError:
+            salvaged[key] = value
+    return salvaged
 
+def parse_soap_note(medical_note_text):
+    """
+    Post-processes the model output into the SOAP note sections and action
+    items. Function-call output is JSON and is used directly; free text is
+    read in a single pass by SoapSectionParser.
+    """
+    medical_note = empty_soap_note()
+    structured = load_structured_note(medical_note_text)
+    if isinstance(structured, dict):
+        for key, value in structured.items():
+            name = section_name(key)
+            if name in soap_sections:
+                medical_note[name] = value.strip() if isinstance(value, str) else ""
+            elif name and isinstance(value, list):
+                medical_note[name] = value
+            elif name and isinstance(value, str):
+                medical_note[name] = parse_action_items(name, value)
+        return medical_note
+
+    parser = SoapSectionParser()
+    for name, content in parser.feed(medical_note_text) + parser.close():
+        medical_note[name] = parse_section(name, content)
     return medical_note
+
+async def generate_soap_note(
+    resources, source_path, file_extension, medical_history, workdir, progress=None, audio_info=None
+):
+    """
+    Runs the whole pipeline for one spooled upload: decode, transcribe and
+    turn the conversation into a SOAP note. progress, if given, is called
+    with (event, data) as each stage advances. audio_info is the upload's
+    probe result, if it was admitted already. Raises SoapNoteError on failure.
+    """
+    upload_bytes.observe(os.path.getsize(source_path), format=file_extension[1:] or "unknown")
+    with timed_stage("total"):
+        with timed_stage("decode"):
+            audio_path = await decode_audio(source_path, file_extension, workdir, audio_info)
+        report(progress, "decoded")
+
+        # Long visits are summarised chunk by chunk while the rest is still being transcribed
+        duration = (await run_blocking(probe_wav, audio_path)).duration
+        findings_map = None
+        if map_reduce_min_seconds > 0 and duration >= map_reduce_min_seconds:
+            findings_map = FindingsMap(resources, progress)
+            report(progress, "map_reduce", duration=duration)
+
+        try:
+            # Translate audio
+            with timed_stage("transcribe"):
+                translation = await transcribe_audio(
+                    audio_path, resources, progress, findings_map.add if findings_map else None
+                )
+            if findings_map:
+                with timed_stage("extract"):
+                    translation = await findings_map.gather(translation)
+        finally:
+            if findings_map:
+                await findings_map.cancel()
+
+        return await summarise_transcript(medical_history, translation, resources, progress)
+
+async def summarise_transcript(medical_history, translation, resources, progress=None):
+    """Turns a transcript (or map-reduce findings) and the medical history into a parsed SOAP note."""
+    # Combine medical history with translated text, within the token budget
+    full_text = await fit_to_budget(medical_history, translation, resources, progress)
+
+    # Generating medical note
+    with timed_stage("llm"):
+        medical_note_text = await write_soap_note(full_text, resources, progress)
+
+    return parse_soap_note(medical_note_text)
+
+def pcm_to_wav(pcm):
+    """Wraps mono 16-bit PCM at speech_sample_rate in an in-memory WAV file."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(speech_sample_rate)
+        wav_file.writeframes(pcm[:len(pcm) - len(pcm) % 2])
+    return buffer.getvalue()
+
+def find_cut(wav_bytes):
+    """Frame at which to end a live segment: the pause nearest chunk_duration seconds, or exactly there."""
+    frame_rate, _, _, pauses = plan_speech(io.BytesIO(wav_bytes))
+    target = int(chunk_duration * frame_rate)
+    search = int(chunk_cut_search * frame_rate)
+    nearby = [pause for pause in pauses if 0 < pause and abs(pause - target) <= search]
+    return min(nearby, key=lambda pause: abs(pause - target)) if nearby else target
+
+class LiveProtocolError(SoapNoteError):
+    """Raised when a live client breaks the message protocol or goes silent."""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+async def receive_live(websocket):
+    """Next message from a live client; raises LiveProtocolError after live_receive_timeout of silence."""
+    try:
+        return await asyncio.wait_for(websocket.receive(), live_receive_timeout)
+    except asyncio.TimeoutError:
+        raise LiveProtocolError(f"Nothing was received for {live_receive_timeout:g} seconds.") from None
+
+def parse_live_control(text):
+    """The JSON object of a live client's text frame; raises LiveProtocolError if it isn't one."""
+    try:
+        control = json.loads(text or "")
+    except ValueError:
+        control = None
+    if not isinstance(control, dict):
+        raise LiveProtocolError('Text messages must be JSON objects, such as {"event": "end"}.')
+    return control
+
+class LiveSession:
+    """
+    One recording arriving piece by piece while the visit is still going on.
+    A persistent ffmpeg process decodes the container stream to mono PCM at
+    speech_sample_rate. Whenever more than chunk_duration seconds are
+    pending, a segment is cut at the nearest pause and transcribed in the
+    background, so at the end only the last segment is left to transcribe.
+    The decoder lives as long as the visit, so it doesn't take a
+    decode_semaphore slot; live_max_sessions bounds the decoders instead.
+    """
+
+    def __init__(self, resources, audio_format="webm", progress=None):
+        self.resources = resources
+        self.audio_format = audio_format
+        self.progress = progress
+        self.pending = bytearray()
+        self.decoded_bytes = 0
+        self.segments = []  # transcription tasks, in recording order
+        self.error = None
+        self.process = None
+        self.reader = None
+        self.stderr = None
+
+    @property
+    def duration(self):
+        return self.decoded_bytes / 2 / speech_sample_rate
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0", "-vn", "-ac", "1", "-ar", str(speech_sample_rate),
+            "-c:a", "pcm_s16le", "-f", "s16le", "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self.stderr = asyncio.create_task(self.process.stderr.read())
+        self.reader = asyncio.create_task(self._read())
+
+    async def feed(self, data):
+        """Passes a piece of the encoded recording to the decoder; raises once the session has failed."""
+        self._check()
+        try:
+            self.process.stdin.write(data)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg gave up on the input; finish() reports why
+            pass
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+        for task in self.segments:
+            if task.done() and not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+    async def _read(self):
+        segment_bytes = int((chunk_duration + chunk_cut_search) * speech_sample_rate) * 2
+        try:
+            while data := await self.process.stdout.read(65536):
+                self.pending += data
+                self.decoded_bytes += len(data)
+                if self.duration > max_recording_seconds:
+                    check_duration(self.duration)
+                while len(self.pending) >= segment_bytes:
+                    cut = await run_blocking(find_cut, pcm_to_wav(self.pending))
+                    self._transcribe(bytes(self.pending[:cut * 2]))
+                    del self.pending[:cut * 2]
+        except Exception as e:
+            self.error = e
+            # Keep draining so ffmpeg, and so feed(), never block on a full pipe
+            while await self.process.stdout.read(65536):
+                pass
+
+    def _transcribe(self, pcm):
+        index = len(self.segments)
+        self.segments.append(asyncio.create_task(self._transcribe_segment(index, pcm)))
+
+    async def _transcribe_segment(self, index, pcm):
+        wav_bytes = pcm_to_wav(pcm)
+        _, _, kept, _ = await run_blocking(plan_speech, io.BytesIO(wav_bytes))
+        text = ""
+        if kept:
+            chunk = await encode_for_upload(await run_blocking(read_wav_ranges, io.BytesIO(wav_bytes), kept))
+            chunk_bytes.observe(len(chunk))
+            start = time.perf_counter()
+            text = await translate_with_retry(
+                self.resources.openai_client, (f"segment_{index}.ogg", chunk), f"live segment {index}"
+            )
+            chunk_seconds.observe(time.perf_counter() - start)
+        report(self.progress, "segment_transcribed", index=index, text=text)
+        return text.strip()
+
+    async def finish(self):
+        """
+        Ends the recording: flushes the decoder, transcribes the last segment
+        and returns the transcript. Visits of map_reduce_min_seconds or more
+        come back as findings extracted from each segment, concurrently.
+        """
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        await self.reader
+        returncode = await self.process.wait()
+        stderr = await self.stderr
+        self._check()
+        if returncode != 0:
+            detail = stderr.decode(errors="replace").strip() or f"ffmpeg exited with {returncode}"
+            raise AudioDecodeError(detail, self.audio_format)
+        check_duration(self.duration)
+        audio_seconds.observe(self.duration)
+        if self.pending:
+            self._transcribe(bytes(self.pending))
+            self.pending.clear()
+        texts = await asyncio.gather(*self.segments)
+        translation = " ".join(text for text in texts if text)
+        if map_reduce_min_seconds <= 0 or self.duration < map_reduce_min_seconds:
+            return translation
+        findings_map = FindingsMap(self.resources, self.progress)
+        try:
+            for index, text in enumerate(texts):
+                findings_map.add(index, len(texts), text)
+            with timed_stage("extract"):
+                return await findings_map.gather(translation)
+        finally:
+            await findings_map.cancel()
+
+    async def close(self):
+        """Stops the decoder and any transcription still running."""
+        tasks = [task for task in self.segments + [self.reader, self.stderr] if task is not None]
+        for task in tasks:
+            task.cancel()
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def upload_extension(audio_file):
+    return os.path.splitext(audio_file.filename)[1].lower()
+
+def queue_full_error():
+    return HTTPException(
+        status_code=503,
+        detail="Too many SOAP notes in progress. Please retry later.",
+        headers={"Retry-After": str(job_retry_after)},
+    )
+
+def upstream_unavailable_error(retry_after):
+    return HTTPException(
+        status_code=503,
+        detail=UpstreamUnavailableError.message,
+        headers={"Retry-After": str(math.ceil(retry_after))},
+    )
+
+def check_upstream():
+    """Refuses new work up front while either OpenAI circuit breaker is open."""
+    retry_after = max(whisper_scheduler.breaker.retry_after(), llm_scheduler.breaker.retry_after())
+    if retry_after > 0:
+        raise upstream_unavailable_error(retry_after)
+
+
+@app.get("/")
+async def read_root():
+    return {"message": "Welcome to the SOAP note generator API"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"backend": state_backend_name, "transcripts": transcript_cache.stats(), "notes": note_cache.stats()}
+
+@app.post("/soap_note/")
+async def create_soap_note(
+    audio_file: UploadFile = File(...),
+    medical_history: str = Form(...),
+    resources: Resources = Depends(get_resources)
+):
+    check_upstream()
+
+    # Check file extension
+    file_extension = upload_extension(audio_file)
+
+    # Save audio file into a scratch directory private to this request
+    with tempfile.TemporaryDirectory(prefix="soap_", dir=scratch_root) as workdir:
+        source_path = os.path.join(workdir, f"upload{file_extension}")
+        try:
+            audio_info = await receive_upload(audio_file, source_path)
+            return await generate_soap_note(
+                resources, source_path, file_extension, medical_history, workdir, audio_info=audio_info
+            )
+        except AudioRejectedError as e:
+            logger.info("Rejected upload: %s", e.message)
+            raise rejected_error(e)
+        except UpstreamUnavailableError as e:
+            logger.warning("Error generating SOAP note: %s", e)
+            raise upstream_unavailable_error(e.retry_after)
+        except SoapNoteError as e:
+            logger.warning("Error generating SOAP note: %s", e)
+            return {"error": e.message}
+
+@app.post("/soap_note/jobs", status_code=202)
+async def create_soap_note_job(
+    audio_file: UploadFile = File(...),
+    medical_history: str = Form(...),
+    resources: Resources = Depends(get_resources)
+):
+    # Refuse before copying the upload if the backlog is already full
+    if resources.jobs.full():
+        raise queue_full_error()
+    check_upstream()
+
+    file_extension = upload_extension(audio_file)
+
+    # The job outlives this request, so its scratch directory is removed by the worker
+    workdir = tempfile.mkdtemp(prefix="soap_job_", dir=scratch_root)
+    source_path = os.path.join(workdir, f"upload{file_extension}")
+    try:
+        audio_info = await receive_upload(audio_file, source_path)
+        job = await resources.jobs.submit(
+            lambda: generate_soap_note(
+                resources, source_path, file_extension, medical_history, workdir, audio_info=audio_info
+            ),
+            workdir,
+        )
+    except AudioRejectedError as e:
+        shutil.rmtree(workdir, ignore_errors=True)
+        logger.info("Rejected upload: %s", e.message)
+        raise rejected_error(e)
+    except asyncio.QueueFull:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise queue_full_error()
+    except BaseException:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+    return {"job_id": job.id, "status": job.status}
+
+@app.post("/soap_note/stream")
+async def stream_soap_note(
+    audio_file: UploadFile = File(...),
+    medical_history: str = Form(...),
+    resources: Resources = Depends(get_resources)
+):
+    """
+    Server-Sent Events variant of /soap_note/. Emits progress events
+    (decoded, map_reduce, chunk_transcribed, findings_extracted,
+    transcribed, condensing, tokens, llm_started or note_cached), the model
+    output as token events, each finished section as a section event, and
+    finally done with the whole note or error.
+    """
+    check_upstream()
+
+    file_extension = upload_extension(audio_file)
+
+    # The stream outlives this handler, so its scratch directory is removed by the pipeline task
+    workdir = tempfile.mkdtemp(prefix="soap_stream_", dir=scratch_root)
+    source_path = os.path.join(workdir, f"upload{file_extension}")
+    try:
+        audio_info = await receive_upload(audio_file, source_path)
+    except AudioRejectedError as e:
+        shutil.rmtree(workdir, ignore_errors=True)
+        logger.info("Rejected upload: %s", e.message)
+        raise rejected_error(e)
+    except BaseException:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+
+    events = asyncio.Queue()
+    parser = SoapSectionParser()
+    emitted = set()
+
+    def emit_sections(sections):
+        for name, content in sections:
+            emitted.add(name)
+            events.put_nowait(("section", {"name": name, "content": parse_section(name, content)}))
+
+    def progress(event, data):
+        events.put_nowait((event, data))
+        if event == "token":
+            emit_sections(parser.feed(data["text"]))
+
+    async def run():
+        try:
+            medical_note = await generate_soap_note(
+                resources, source_path, file_extension, medical_history, workdir, progress, audio_info
+            )
+            emit_sections(parser.close())
+            # A cached note streams no tokens, so its sections are all sent from here
+            for name, value in medical_note.items():
+                if name not in emitted:
+                    events.put_nowait(("section", {"name": name, "content": value}))
+            events.put_nowait(("done", medical_note))
+        except SoapNoteError as e:
+            logger.warning("Error generating SOAP note: %s", e)
+            events.put_nowait(("error", {"message": e.message}))
+        except Exception:
+            logger.exception("Error generating SOAP note")
+            events.put_nowait(("error", {"message": SoapNoteError.message}))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            events.put_nowait(None)
+
+    async def event_stream():
+        task = asyncio.create_task(run())
+        try:
+            while (item := await events.get()) is not None:
+                event, data = item
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            # Stop the pipeline if the client went away mid-stream
+            task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/soap_note/batch")
+async def create_soap_note_batch(
+    audio_files: List[UploadFile] = File(...),
+    medical_histories: List[str] = Form(...),
+    stream: bool = Form(False),
+    resources: Resources = Depends(get_resources)
+):
+    """
+    Generates notes for several consultations in one call. The n-th
+    medical_histories field belongs to the n-th audio file. Items share the
+    process-wide Whisper and LLM limits. With stream=true each result is
+    sent as an NDJSON line as soon as it completes; otherwise all results
+    are returned together in upload order.
+    """
+    check_upstream()
+
+    if len(audio_files) != len(medical_histories):
+        raise HTTPException(status_code=422, detail="Send one medical_histories field per audio file.")
+    if len(audio_files) > batch_max_items:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {batch_max_items} recordings.")
+
+    # The batch may outlive this handler when streamed, so cleanup is left to run_batch
+    workdir = tempfile.mkdtemp(prefix="soap_batch_", dir=scratch_root)
+    items = []
+    # Recordings that fail admission are reported without being processed
+    rejected = []
+    try:
+        for index, (audio_file, medical_history) in enumerate(zip(audio_files, medical_histories)):
+            item_dir = os.path.join(workdir, str(index))
+            os.mkdir(item_dir)
+            file_extension = upload_extension(audio_file)
+            source_path = os.path.join(item_dir, f"upload{file_extension}")
+            try:
+                audio_info = await receive_upload(audio_file, source_path)
+            except AudioRejectedError as e:
+                logger.info("Rejected batch item %d: %s", index, e.message)
+                rejected.append({"index": index, "filename": audio_file.filename, "error": e.message})
+                shutil.rmtree(item_dir, ignore_errors=True)
+                continue
+            items.append(
+                (index, audio_file.filename, source_path, file_extension, medical_history, item_dir, audio_info)
+            )
+    except BaseException:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+
+    semaphore = asyncio.Semaphore(batch_concurrency)
+
+    async def run_item(index, filename, source_path, file_extension, medical_history, item_dir, audio_info):
+        result = {"index": index, "filename": filename}
+        async with semaphore:
+            try:
+                result["result"] = await generate_soap_note(
+                    resources, source_path, file_extension, medical_history, item_dir, audio_info=audio_info
+                )
+            except SoapNoteError as e:
+                logger.warning("Batch item %d failed: %s", index, e)
+                result["error"] = e.message
+            except Exception:
+                logger.exception("Batch item %d failed", index)
+                result["error"] = SoapNoteError.message
+            finally:
+                shutil.rmtree(item_dir, ignore_errors=True)
+        return result
+
+    async def run_batch():
+        tasks = [asyncio.create_task(run_item(*item)) for item in items]
+        try:
+            for result in rejected:
+                yield result
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            # Stop outstanding items if the client went away mid-stream
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if stream:
+        async def ndjson():
+            async for result in run_batch():
+                yield json.dumps(result) + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    results = [result async for result in run_batch()]
+    return {"results": sorted(results, key=lambda result: result["index"])}
+
+@app.websocket("/soap_note/live")
+async def live_soap_note(websocket: WebSocket):
+    """
+    Live variant of /soap_note/ that transcribes while the visit is recorded.
+    The client sends {"medical_history": ..., "format": "webm"} as its first
+    (text) message, then the recording as binary frames as it is produced,
+    then {"event": "end"}. The server sends JSON events: segment_transcribed
+    as each segment is transcribed, the progress and token events of
+    /soap_note/stream once the recording has ended, and finally done with
+    the note or error, after which it closes the socket. Sessions beyond
+    live_max_sessions, and any while OpenAI is unavailable, are refused with
+    close code 1013; protocol errors and clients silent for
+    live_receive_timeout are closed with 1008.
+    """
+    await websocket.accept()
+    try:
+        check_upstream()
+    except HTTPException as e:
+        await websocket.send_json({"event": "error", "message": e.detail})
+        await websocket.close(code=1013)
+        return
+    if live_sessions.locked():
+        message = "Too many live sessions in progress. Please retry later."
+        await websocket.send_json({"event": "error", "message": message})
+        await websocket.close(code=1013)
+        return
+    async with live_sessions:
+        await run_live_session(websocket)
+
+async def run_live_session(websocket):
+    resources = websocket.app.state.resources
+    try:
+        message = await receive_live(websocket)
+        if message["type"] == "websocket.disconnect":
+            logger.info("Live client disconnected before starting")
+            return
+        try:
+            start = parse_live_control(message.get("text"))
+        except LiveProtocolError:
+            start = {}
+        if not isinstance(start.get("medical_history"), str):
+            raise LiveProtocolError("Start with a JSON message holding medical_history.")
+    except LiveProtocolError as e:
+        logger.info("Live client rejected: %s", e.message)
+        await websocket.send_json({"event": "error", "message": e.message})
+        await websocket.close(code=1008)
+        return
+
+    events = asyncio.Queue()
+
+    def progress(event, data):
+        events.put_nowait({"event": event, **data})
+
+    async def send_events():
+        while (message := await events.get()) is not None:
+            await websocket.send_json(message)
+
+    sender = asyncio.create_task(send_events())
+    session = LiveSession(resources, start.get("format", "webm"), progress)
+    connected = True
+    close_code = 1000
+    try:
+        await session.start()
+        while True:
+            message = await receive_live(websocket)
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is not None:
+                await session.feed(message["bytes"])
+            elif parse_live_control(message.get("text")).get("event") == "end":
+                break
+
+        # Only the last segment and the note itself are left at this point
+        with timed_stage("live_finish"):
+            translation = await session.finish()
+            report(progress, "transcribed", cached=False)
+            medical_note = await summarise_transcript(start["medical_history"], translation, resources, progress)
+        progress("done", {"note": medical_note})
+    except WebSocketDisconnect:
+        logger.info("Live client disconnected")
+        connected = False
+    except LiveProtocolError as e:
+        logger.info("Live client dropped: %s", e.message)
+        progress("error", {"message": e.message})
+        close_code = 1008
+    except SoapNoteError as e:
+        logger.warning("Error generating SOAP note: %s", e)
+        progress("error", {"message": e.message})
+        close_code = 1011
+    except Exception:
+        logger.exception("Error generating SOAP note")
+        progress("error", {"message": SoapNoteError.message})
+        close_code = 1011
+    finally:
+        await session.close()
+        events.put_nowait(None)
+        if connected:
+            await asyncio.gather(sender, return_exceptions=True)
+            await websocket.close(code=close_code)
+        else:
+            sender.cancel()
+
+@app.get("/soap_note/jobs/{job_id}")
+async def get_soap_note_job(job_id: str, resources: Resources = Depends(get_resources)):
+    job = await resources.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
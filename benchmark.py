@@ -0,0 +1,388 @@
+"""
+Offline load test for the SOAP note API. Starts fake_openai.py and the app
+under uvicorn, uploads synthetic recordings at a fixed concurrency and
+reports throughput, client latency percentiles, per-stage latency
+percentiles (from the app's Server-Timing headers, or its /metrics
+histograms for endpoints without them) and peak RSS of the app processes.
+A request's latency runs until its note is done: /soap_note/jobs is polled
+until the job finishes and /soap_note/stream is read until its done event.
+
+Example:
+    python benchmark.py --requests 40 --concurrency 8 --durations 60,600 --formats wav,webm
+    python benchmark.py --endpoint /soap_note/stream --failure-rate 0.05 --output results.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import httpx
+import imageio_ffmpeg as ffmpeg
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+endpoints = ("/soap_note/", "/soap_note/jobs", "/soap_note/stream")
+job_poll_interval = 0.2  # seconds
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def synthetic_speech(duration, frame_rate=44100, seed=0):
+    """
+    Speech-like test signal: voiced bursts of a few hundred ms (a wobbling
+    fundamental with harmonics) separated by short gaps, with occasional
+    multi-second pauses and a little background noise. Returns stereo int16.
+    """
+    rng = np.random.default_rng(seed)
+    samples = int(duration * frame_rate)
+    signal = rng.normal(0, 0.003, samples)
+    position = 0
+    while position < samples:
+        length = int(rng.uniform(0.2, 0.8) * frame_rate)
+        t = np.arange(min(length, samples - position)) / frame_rate
+        pitch = rng.uniform(100, 220) * (1 + 0.05 * np.sin(2 * np.pi * 4 * t))
+        phase = 2 * np.pi * np.cumsum(pitch) / frame_rate
+        burst = sum(np.sin(k * phase) / k for k in range(1, 6)) * np.hanning(len(t)) * 0.3
+        signal[position:position + len(t)] += burst
+        gap = rng.uniform(2, 6) if rng.random() < 0.1 else rng.uniform(0.05, 0.4)
+        position += len(t) + int(gap * frame_rate)
+    pcm = (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+    return np.repeat(pcm[:, None], 2, axis=1)
+
+
+def make_recordings(directory, durations, formats):
+    """Writes one synthetic recording per duration and format; returns their paths."""
+    paths = []
+    for duration in durations:
+        wav_path = os.path.join(directory, f"synthetic_{duration}s.wav")
+        with wave.open(wav_path, "wb") as wav_file:
+            wav_file.setnchannels(2)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(44100)
+            wav_file.writeframes(synthetic_speech(duration, seed=duration).tobytes())
+        for audio_format in formats:
+            if audio_format == "wav":
+                paths.append(wav_path)
+                continue
+            path = os.path.join(directory, f"synthetic_{duration}s.{audio_format}")
+            codec = {"mp3": "libmp3lame", "webm": "libopus"}[audio_format]
+            subprocess.run(
+                [ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error", "-y",
+                 "-i", wav_path, "-c:a", codec, path],
+                check=True,
+            )
+            paths.append(path)
+    return paths
+
+
+def start_server(module, port, env, workers=1):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=here,
+        env={**os.environ, **env},
+    )
+
+
+def wait_until_up(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout} seconds")
+
+
+def process_tree_rss(root_pid):
+    """Resident memory in bytes of root_pid and all its descendants (Linux /proc)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; fields resume after its closing paren
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    total = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                match = re.search(r"VmRSS:\s+(\d+) kB", f.read())
+            total += int(match.group(1)) * 1024 if match else 0
+        except OSError:
+            pass
+    return total
+
+
+async def sample_peak_rss(pid, peak, interval=0.1):
+    while True:
+        peak[0] = max(peak[0], process_tree_rss(pid))
+        await asyncio.sleep(interval)
+
+
+def parse_histograms(text, name):
+    """Parses one histogram from Prometheus text into {labels: {le: count}}."""
+    histograms = {}
+    pattern = re.compile(rf'^{name}_bucket\{{(.*)\}} (\S+)$')
+    for line in text.splitlines():
+        match = pattern.match(line)
+        if not match:
+            continue
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', match.group(1)))
+        le = labels.pop("le")
+        key = tuple(sorted(labels.items()))
+        histograms.setdefault(key, {})[float(le)] = float(match.group(2))
+    return histograms
+
+
+def histogram_quantile(quantile, buckets):
+    """Estimates a quantile from cumulative bucket counts, interpolating within a bucket."""
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]]
+    if total == 0:
+        return None
+    rank = quantile * total
+    previous_bound, previous_count = 0.0, 0.0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if bound == float("inf"):
+                return previous_bound
+            if count == previous_count:
+                return bound
+            return previous_bound + (bound - previous_bound) * (rank - previous_count) / (count - previous_count)
+        previous_bound, previous_count = bound, count
+    return previous_bound
+
+
+def parse_server_timing(header):
+    """Yields (stage, seconds) from a Server-Timing header such as "decode;dur=81.2, llm;dur=5012.0"."""
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        match = re.search(r"dur=([\d.]+)", params)
+        if name and match:
+            yield name, float(match.group(1)) / 1000
+
+
+def timing_percentiles(stage_timings):
+    """Exact per-stage p50/p95/p99 from the Server-Timing headers of every response."""
+    return {
+        stage: {
+            **{f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)},
+            "count": len(values),
+        }
+        for stage, values in stage_timings.items()
+    }
+
+
+def stage_percentiles(before, after):
+    """
+    Per-stage p50/p95/p99 over the benchmark window, estimated from the
+    /metrics histograms scraped before and after. Only as precise as the
+    buckets; used for endpoints whose responses carry no Server-Timing.
+    """
+    start = parse_histograms(before, "soap_stage_seconds")
+    end = parse_histograms(after, "soap_stage_seconds")
+    results = {}
+    for key, buckets in end.items():
+        delta = {le: count - start.get(key, {}).get(le, 0) for le, count in buckets.items()}
+        stage = dict(key).get("stage", "?")
+        results[stage] = {
+            f"p{int(q * 100)}": histogram_quantile(q, delta) for q in (0.5, 0.95, 0.99)
+        }
+        results[stage]["count"] = delta[float("inf")]
+    return results
+
+
+async def request_note(client, endpoint, files, data, stage_timings):
+    """Runs one consultation through endpoint until its note is done; returns "ok" or "error"."""
+    if endpoint == "/soap_note/stream":
+        async with client.stream("POST", endpoint, files=files, data=data) as response:
+            if response.status_code != 200:
+                return "error"
+            async for line in response.aiter_lines():
+                if line in ("event: done", "event: error"):
+                    return "ok" if line == "event: done" else "error"
+        # The stream ended without a final event
+        return "error"
+
+    response = await client.post(endpoint, files=files, data=data)
+    if endpoint == "/soap_note/jobs":
+        if response.status_code != 202:
+            return "error"
+        job_url = f"/soap_note/jobs/{response.json()['job_id']}"
+        while True:
+            await asyncio.sleep(job_poll_interval)
+            job = (await client.get(job_url)).json()
+            if job["status"] in ("done", "failed"):
+                return "ok" if job["status"] == "done" else "error"
+
+    body = response.json()
+    for stage, seconds in parse_server_timing(response.headers.get("server-timing", "")):
+        stage_timings.setdefault(stage, []).append(seconds)
+    return "error" if response.status_code != 200 or "error" in body else "ok"
+
+
+async def run_load(base_url, endpoint, recordings, total, concurrency):
+    latencies = []
+    outcomes = {}
+    stage_timings = {}
+    queue = asyncio.Queue()
+    for index, path in zip(range(total), itertools.cycle(recordings)):
+        queue.put_nowait((index, path))
+
+    async def client_loop(client):
+        while not queue.empty():
+            index, path = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                with open(path, "rb") as audio:
+                    outcome = await request_note(
+                        client,
+                        endpoint,
+                        files={"audio_file": (os.path.basename(path), audio)},
+                        data={"medical_history": f"Benchmark consultation {index}"},
+                        stage_timings=stage_timings,
+                    )
+            except (httpx.HTTPError, ValueError) as e:
+                outcome = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    timeout = httpx.Timeout(None, connect=10)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return elapsed, latencies, outcomes, stage_timings
+
+
+async def benchmark(args, recordings):
+    fake_port, app_port = free_port(), free_port()
+    fake_env = {
+        "FAKE_WHISPER_LATENCY": str(args.whisper_latency),
+        "FAKE_WHISPER_PER_MB": str(args.whisper_per_mb),
+        "FAKE_CHAT_LATENCY": str(args.chat_latency),
+        "FAKE_FAILURE_RATE": str(args.failure_rate),
+        "FAKE_FAILURE_STATUS": str(args.failure_status),
+    }
+    app_env = {
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+        "LOG_LEVEL": "WARNING",
+    }
+    if not args.cache:
+        # Every request should pay for the full pipeline
+        app_env.update({"TRANSCRIPT_CACHE_SIZE": "0", "NOTE_CACHE_SIZE": "0"})
+
+    fake = start_server("fake_openai", fake_port, fake_env)
+    app = start_server("app", app_port, app_env, args.workers)
+    base_url = f"http://127.0.0.1:{app_port}"
+    try:
+        wait_until_up(f"http://127.0.0.1:{fake_port}/docs")
+        wait_until_up(base_url + "/")
+        before = httpx.get(base_url + "/metrics").text
+        peak = [process_tree_rss(app.pid)]
+        sampler = asyncio.create_task(sample_peak_rss(app.pid, peak))
+        try:
+            elapsed, latencies, outcomes, stage_timings = await run_load(
+                base_url, args.endpoint, recordings, args.requests, args.concurrency
+            )
+        finally:
+            sampler.cancel()
+        after = httpx.get(base_url + "/metrics").text
+    finally:
+        for process in (app, fake):
+            process.terminate()
+            process.wait(timeout=30)
+
+    # Server-Timing covers every request; the histograms are the fallback, and with
+    # several workers each scrape only sees one of them
+    stages = timing_percentiles(stage_timings) if stage_timings else stage_percentiles(before, after)
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "recordings": [os.path.basename(path) for path in recordings],
+        "elapsed_seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed,
+        "outcomes": outcomes,
+        "latency_seconds": {
+            f"p{q}": float(np.percentile(latencies, q)) for q in (50, 95, 99)
+        },
+        "stage_seconds": stages,
+        "peak_rss_bytes": peak[0],
+    }
+
+
+def print_report(results):
+    print(f"Requests:      {results['requests']} at concurrency {results['concurrency']}"
+          f" ({results['workers']} worker(s))")
+    print(f"Recordings:    {', '.join(results['recordings'])}")
+    print(f"Outcomes:      {results['outcomes']}")
+    print(f"Throughput:    {results['requests_per_second']:.2f} requests/s"
+          f" over {results['elapsed_seconds']:.1f} s")
+    latency = results["latency_seconds"]
+    print(f"Latency:       p50 {latency['p50']:.2f} s  p95 {latency['p95']:.2f} s  p99 {latency['p99']:.2f} s")
+    print(f"Peak RSS:      {results['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+    print("Stages:")
+    for stage, values in sorted(results["stage_seconds"].items()):
+        quantiles = "  ".join(
+            f"{name} {value:.2f} s" if value is not None else f"{name} -"
+            for name, value in values.items() if name != "count"
+        )
+        print(f"  {stage:<12} {quantiles}  (n={values['count']:.0f})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the app")
+    parser.add_argument("--endpoint", default="/soap_note/", choices=endpoints)
+    parser.add_argument("--durations", default="30,180", help="comma-separated recording lengths in seconds")
+    parser.add_argument("--formats", default="wav,mp3,webm")
+    parser.add_argument("--whisper-latency", type=float, default=1.0)
+    parser.add_argument("--whisper-per-mb", type=float, default=0.5)
+    parser.add_argument("--chat-latency", type=float, default=5.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-status", type=int, default=429)
+    parser.add_argument("--cache", action="store_true", help="leave the transcript and note caches on")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    durations = [int(d) for d in args.durations.split(",")]
+    formats = args.formats.split(",")
+    with tempfile.TemporaryDirectory(prefix="soap_bench_") as directory:
+        recordings = make_recordings(directory, durations, formats)
+        results = asyncio.run(benchmark(args, recordings))
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
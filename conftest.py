@@ -0,0 +1,3 @@
+# Puts app.py on the import path for tests/. test_api.py is a manual script that
+# posts to a running server, not a test module.
+collect_ignore = ["test_api.py"]
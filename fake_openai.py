@@ -0,0 +1,142 @@
+"""
+Local stand-in for the OpenAI endpoints the app uses (audio translations and
+transcriptions, chat completions), for benchmarks that shouldn't cost API
+money. Configured through environment variables:
+
+    FAKE_WHISPER_LATENCY   seconds per audio request (default 1.0)
+    FAKE_WHISPER_PER_MB    extra seconds per MB uploaded (default 0.5)
+    FAKE_CHAT_LATENCY      seconds per chat completion (default 5.0)
+    FAKE_FAILURE_RATE      fraction of requests that fail (default 0)
+    FAKE_FAILURE_STATUS    status code of injected failures (default 429)
+
+Run with: uvicorn fake_openai:app --port 8100
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import asyncio
+import json
+import os
+import random
+import time
+
+whisper_latency = float(os.getenv("FAKE_WHISPER_LATENCY", 1.0))
+whisper_per_mb = float(os.getenv("FAKE_WHISPER_PER_MB", 0.5))
+chat_latency = float(os.getenv("FAKE_CHAT_LATENCY", 5.0))
+failure_rate = float(os.getenv("FAKE_FAILURE_RATE", 0))
+failure_status = int(os.getenv("FAKE_FAILURE_STATUS", 429))
+
+soap_note = """Subjective: Owner reports two days of vomiting and reduced appetite.
+The dog is still drinking water.
+
+Objective: Temperature 39.4 C, heart rate 110 bpm, mild abdominal discomfort on palpation.
+Assessment: Findings are consistent with acute gastroenteritis.
+Plan: Bland diet for five days, anti-emetic, recheck in three days if vomiting persists.
+Conclusion: Acute gastroenteritis managed as an outpatient with dietary change and medication.
+Differentialdiagnosis: Gastroenterology-Gastroenteritis
+Preventive:
+Vaccinations: Rabies, 01-12-2026
+Deworming: Praziquantel, 15-11-2026
+Prescription:
+Name: Maropitant
+Duration: 3 days
+Dosage: 1 mg/kg
+Frequency: Morning
+Remarks: After meal
+Dietrecommendations: Boiled chicken and rice in small frequent meals.
+Diagnostics: Complete blood count, 20-10-2026
+"""
+
+condensed_transcript = "Owner reports two days of vomiting and reduced appetite; the dog is still drinking."
+
+structured_soap_note = {
+    "Subjective": "Owner reports two days of vomiting and reduced appetite. The dog is still drinking water.",
+    "Objective": "Temperature 39.4 C, heart rate 110 bpm, mild abdominal discomfort on palpation.",
+    "Assessment": "Findings are consistent with acute gastroenteritis.",
+    "Plan": "Bland diet for five days, anti-emetic, recheck in three days if vomiting persists.",
+    "Conclusion": "Acute gastroenteritis managed as an outpatient with dietary change and medication.",
+    "DifferentialDiagnosis": "Gastroenterology-Gastroenteritis",
+    "Preventive": [
+        {"Type": "Vaccination", "Name": "Rabies", "Date": "01-12-2026"},
+        {"Type": "Deworming", "Name": "Praziquantel", "Date": "15-11-2026"},
+    ],
+    "Prescription": [
+        {"Name": "Maropitant", "Duration": "3 days", "Dosage": "1 mg/kg", "Frequency": "Morning", "Remarks": "After meal"},
+    ],
+    "Dietrecommendations": ["Boiled chicken and rice in small frequent meals."],
+    "Diagnostics": [{"Name": "Complete blood count", "Date": "20-10-2026"}],
+}
+
+app = FastAPI()
+
+def injected_failure():
+    if random.random() < failure_rate:
+        return JSONResponse(
+            {"error": {"message": "Injected failure", "type": "fake_error", "code": None}},
+            status_code=failure_status,
+        )
+    return None
+
+@app.post("/v1/audio/{operation}")
+async def audio(operation: str, request: Request):
+    body = await request.body()
+    await asyncio.sleep(whisper_latency + whisper_per_mb * len(body) / 1e6)
+    failure = injected_failure()
+    if failure:
+        return failure
+    return {"text": f"The owner says the dog has been vomiting for two days ({len(body)} bytes of audio)."}
+
+def completion(content, model, function_call=None):
+    message = {"role": "assistant", "content": content}
+    if function_call:
+        message["function_call"] = function_call
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": "function_call" if function_call else "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+def completion_chunk(content, model, finish_reason=None):
+    delta = {"content": content} if content else {}
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "gpt-4")
+    failure = injected_failure()
+    if failure:
+        await asyncio.sleep(chat_latency / 10)
+        return failure
+
+    if body.get("functions"):
+        await asyncio.sleep(chat_latency)
+        arguments = json.dumps(structured_soap_note)
+        return completion(None, model, {"name": body["functions"][0]["name"], "arguments": arguments})
+
+    if not body.get("stream"):
+        await asyncio.sleep(chat_latency)
+        # Transcript condensing calls get a short summary instead of a note
+        prompt = "".join(str(message.get("content")) for message in body.get("messages", []))
+        if "Transcript part" in prompt:
+            return completion(condensed_transcript, model)
+        return completion(soap_note, model)
+
+    async def stream():
+        # Spread the latency over the tokens like a real streamed completion
+        pieces = [soap_note[i:i + 16] for i in range(0, len(soap_note), 16)]
+        for piece in pieces:
+            await asyncio.sleep(chat_latency / len(pieces))
+            yield f"data: {json.dumps(completion_chunk(piece, model))}\n\n"
+        yield f"data: {json.dumps(completion_chunk(None, model, 'stop'))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
@@ -0,0 +1,102 @@
+import asyncio
+import io
+import shutil
+import struct
+import subprocess
+import tempfile
+import wave
+
+import imageio_ffmpeg as ffmpeg
+import pytest
+from starlette.datastructures import UploadFile
+
+import app
+
+frames = b"\x00\x01" * 16000 * 2  # 2 s of mono 16-bit audio at 16 kHz
+
+
+def wav_bytes():
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(16000)
+        wav_file.writeframes(frames)
+    return buffer.getvalue()
+
+
+def streamed_wav_bytes(data_size):
+    """A WAV as streaming recorders write it, with a placeholder data length."""
+    header = b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVEfmt "
+    header += struct.pack("<IHHIIHH", 16, 1, 1, 16000, 32000, 2, 16)
+    return header + b"data" + struct.pack("<I", data_size) + frames
+
+
+def test_wav_header_length_is_trusted_when_data_backs_it():
+    info = app.probe_wav(io.BytesIO(wav_bytes()))
+    assert info.duration == 2
+    assert info.exact_length
+
+
+@pytest.mark.parametrize("data_size", [0, 0xFFFFFFFF])
+def test_streamed_wav_length_comes_from_data(data_size):
+    info = app.probe_wav(io.BytesIO(streamed_wav_bytes(data_size)))
+    assert info.duration == 2
+    assert not info.exact_length
+
+
+def test_only_exact_speech_wav_skips_transcoding(tmp_path):
+    path = str(tmp_path / "upload.wav")
+    with open(path, "wb") as f:
+        f.write(wav_bytes())
+    assert asyncio.run(app.decode_audio(path, ".wav", str(tmp_path), app.probe_wav(path))) == path
+
+    with open(path, "wb") as f:
+        f.write(streamed_wav_bytes(0xFFFFFFFF))
+    decoded = asyncio.run(app.decode_audio(path, ".wav", str(tmp_path), app.probe_wav(path)))
+    assert decoded != path
+    assert app.probe_wav(decoded).exact_length
+
+
+def test_oversized_upload_is_rejected_before_reading(monkeypatch):
+    monkeypatch.setattr(app, "max_recording_bytes", 1024)
+    upload = UploadFile(io.BytesIO(wav_bytes()), size=len(wav_bytes()), filename="visit.wav")
+    with pytest.raises(app.AudioRejectedError) as error:
+        asyncio.run(app.probe_upload(upload))
+    assert error.value.status_code == 413
+    assert upload.file.tell() == 0
+
+
+def test_upload_is_probed_in_place_and_rewound():
+    upload = UploadFile(io.BytesIO(wav_bytes()), size=len(wav_bytes()), filename="visit.wav")
+    info = asyncio.run(app.probe_upload(upload))
+    assert info.duration == 2
+    assert upload.file.tell() == 0
+
+
+def test_mp3_length_is_estimated_before_decoding(monkeypatch, tmp_path):
+    # Without a Xing header ffmpeg has to estimate the length from the file size
+    wav_path, mp3_path = str(tmp_path / "visit.wav"), str(tmp_path / "visit.mp3")
+    with wave.open(wav_path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(16000)
+        wav_file.writeframes(frames * 20)
+    subprocess.run(
+        [ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error", "-i", wav_path,
+         "-c:a", "libmp3lame", "-b:a", "64k", "-write_xing", "0", mp3_path],
+        check=True,
+    )
+    spooled = tempfile.SpooledTemporaryFile(1024 * 1024)
+    with open(mp3_path, "rb") as mp3_file:
+        shutil.copyfileobj(mp3_file, spooled)
+    upload = UploadFile(spooled, size=spooled.tell(), filename="visit.mp3")
+
+    info = asyncio.run(app.probe_upload(upload))
+    assert info.duration == pytest.approx(40, abs=1)
+    assert upload.file.tell() == 0
+
+    monkeypatch.setattr(app, "max_recording_seconds", 30)
+    with pytest.raises(app.AudioRejectedError) as error:
+        asyncio.run(app.probe_upload(upload))
+    assert error.value.status_code == 413
@@ -0,0 +1,93 @@
+import wave
+
+import numpy as np
+import pytest
+
+import app
+
+rate = 1000  # frames per second keeps the numbers readable
+
+
+def seconds(*ranges):
+    return [(start * rate, end * rate) for start, end in ranges]
+
+
+def test_short_speech_is_one_chunk():
+    kept = seconds((0, 30))
+    assert app.plan_chunks(kept, [], rate, 60) == [kept]
+
+
+def test_cuts_at_nearest_pause_within_search(monkeypatch):
+    monkeypatch.setattr(app, "chunk_cut_search", 10)
+    kept = seconds((0, 150))
+    chunks = app.plan_chunks(kept, [52 * rate, 57 * rate, 130 * rate], rate, 60)
+    assert chunks == [seconds((0, 57)), seconds((57, 117)), seconds((117, 150))]
+
+
+def test_cuts_at_target_without_nearby_pause(monkeypatch):
+    monkeypatch.setattr(app, "chunk_cut_search", 5)
+    chunks = app.plan_chunks(seconds((0, 130)), [20 * rate], rate, 60)
+    assert chunks == [seconds((0, 60)), seconds((60, 120)), seconds((120, 130))]
+
+
+def test_chunk_length_counts_kept_audio_only(monkeypatch):
+    monkeypatch.setattr(app, "chunk_cut_search", 0)
+    # 40 s of speech, a trimmed gap, then 40 s more: the cut lands 20 s into the second range
+    kept = seconds((0, 40), (100, 140))
+    assert app.plan_chunks(kept, [], rate, 60) == [seconds((0, 40), (100, 120)), seconds((120, 140))]
+
+
+def test_chunks_cover_all_kept_frames(monkeypatch):
+    monkeypatch.setattr(app, "chunk_cut_search", 10)
+    kept = seconds((0, 35), (40, 95), (99, 230), (240, 250))
+    pauses = [37 * rate, 63 * rate, 97 * rate, 125 * rate, 170 * rate]
+    chunks = app.plan_chunks(kept, pauses, rate, 60)
+    flattened = [frame_range for chunk in chunks for frame_range in chunk]
+    assert sum(end - start for start, end in flattened) == sum(end - start for start, end in kept)
+    assert all(end - start > 0 for start, end in flattened)
+
+
+def write_wav(path, *parts, frame_rate=16000):
+    """Writes (kind, seconds) parts, kind "tone" or "silence", as a mono 16-bit WAV."""
+    samples = []
+    for kind, length in parts:
+        t = np.arange(int(length * frame_rate)) / frame_rate
+        level = 0.5 if kind == "tone" else 0.0
+        samples.append(level * np.sin(2 * np.pi * 440 * t))
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(frame_rate)
+        wav_file.writeframes((np.concatenate(samples) * 32767).astype("<i2").tobytes())
+
+
+def test_plan_speech_squeezes_long_silence_and_finds_pauses(tmp_path):
+    path = str(tmp_path / "visit.wav")
+    write_wav(path, ("tone", 1), ("silence", 3), ("tone", 1), ("silence", 0.5), ("tone", 1))
+    frame_rate, frames, kept, pauses = app.plan_speech(path)
+    assert (frame_rate, frames) == (16000, 6.5 * 16000)
+
+    # The 3 s silence shrinks to vad_keep_silence; the 0.5 s pause is kept whole
+    kept_seconds = sum(end - start for start, end in kept) / frame_rate
+    assert len(kept) == 2
+    assert kept_seconds == pytest.approx(3.5 + app.vad_keep_silence, abs=0.05)
+    assert kept[0][0] == 0 and kept[-1][1] == frames
+    assert kept[0][1] / frame_rate == pytest.approx(1 + app.vad_keep_silence / 2, abs=0.05)
+
+    # Both silences are pauses, cut at their midpoints
+    assert [p / frame_rate for p in pauses] == pytest.approx([2.5, 5.25], abs=0.05)
+
+
+def test_plan_speech_keeps_short_pauses_untrimmed(tmp_path):
+    path = str(tmp_path / "visit.wav")
+    write_wav(path, ("tone", 1), ("silence", 0.5), ("tone", 1))
+    _, frames, kept, pauses = app.plan_speech(path)
+    assert kept == [(0, frames)]
+    assert len(pauses) == 1
+
+
+def test_plan_speech_sends_silent_recording_whole(tmp_path):
+    path = str(tmp_path / "visit.wav")
+    write_wav(path, ("silence", 2))
+    _, frames, kept, pauses = app.plan_speech(path)
+    assert (kept, pauses) == ([(0, frames)], [])
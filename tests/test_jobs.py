@@ -0,0 +1,33 @@
+import asyncio
+
+import app
+
+
+def test_stop_fails_running_and_queued_jobs(monkeypatch, tmp_path):
+    state = app.MemoryStateBackend()
+    monkeypatch.setattr(app, "state", state)
+
+    async def run():
+        jobs = app.JobQueue(workers=1, max_size=4)
+        jobs.start()
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.Event().wait()
+
+        submitted = []
+        for index in range(3):
+            workdir = tmp_path / f"job{index}"
+            workdir.mkdir()
+            submitted.append(await jobs.submit(hang, str(workdir)))
+        await started.wait()
+        await jobs.stop()
+        return [await jobs.get(job.id) for job in submitted]
+
+    records = asyncio.run(run())
+    assert [record.status for record in records] == ["failed"] * 3
+    assert all(record.error and record.finished_at for record in records)
+    # Finished records expire like any other finished job
+    assert all(expires_at is not None for _, expires_at in state.entries.values())
+    assert list(tmp_path.iterdir()) == []
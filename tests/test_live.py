@@ -0,0 +1,47 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import app
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, "api_key", "test")
+    with TestClient(app.app) as client:
+        yield client
+
+
+def error_and_close_code(websocket):
+    error = websocket.receive_json()
+    with pytest.raises(WebSocketDisconnect) as closed:
+        websocket.receive_json()
+    return error["event"], closed.value.code
+
+
+def test_silent_client_is_dropped(client, monkeypatch):
+    monkeypatch.setattr(app, "live_receive_timeout", 0.1)
+    with client.websocket_connect("/soap_note/live") as websocket:
+        assert error_and_close_code(websocket) == ("error", 1008)
+
+
+def test_start_message_must_hold_medical_history(client):
+    with client.websocket_connect("/soap_note/live") as websocket:
+        websocket.send_text("not json")
+        assert error_and_close_code(websocket) == ("error", 1008)
+
+
+def test_text_frame_that_is_not_an_object_is_a_protocol_error(client):
+    with client.websocket_connect("/soap_note/live") as websocket:
+        websocket.send_text(json.dumps({"medical_history": "none"}))
+        websocket.send_text("[1, 2]")
+        assert error_and_close_code(websocket) == ("error", 1008)
+
+
+def test_sessions_beyond_the_cap_are_refused(client, monkeypatch):
+    monkeypatch.setattr(app, "live_sessions", asyncio.Semaphore(0))
+    with client.websocket_connect("/soap_note/live") as websocket:
+        assert error_and_close_code(websocket) == ("error", 1013)
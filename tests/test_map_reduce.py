@@ -0,0 +1,92 @@
+import asyncio
+import gc
+import wave
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def extractions(monkeypatch):
+    """Stubs extract_findings; each part sleeps delays[part] seconds (or forever if None)."""
+    record = {"delays": {}, "cancelled": [], "failing": set()}
+
+    async def extract_findings(segment, part, parts, resources):
+        try:
+            delay = record["delays"].get(part, 0)
+            await (asyncio.sleep(delay) if delay is not None else asyncio.Event().wait())
+        except asyncio.CancelledError:
+            record["cancelled"].append(part)
+            raise
+        if part in record["failing"]:
+            raise RuntimeError(f"extraction {part} failed")
+        return f"findings for {segment}"
+
+    monkeypatch.setattr(app, "extract_findings", extract_findings)
+    return record
+
+
+def test_findings_come_back_in_recording_order(extractions):
+    # Later parts finish first, and chunks report out of order too
+    extractions["delays"] = {1: 0.03, 2: 0.02, 3: 0.01}
+
+    async def run():
+        findings_map = app.FindingsMap(None)
+        for index in (2, 0, 1):
+            findings_map.add(index, 3, f"chunk {index}")
+        return await findings_map.gather("unused")
+
+    findings = asyncio.run(run())
+    assert findings.index("Part 1:\nfindings for chunk 0") < findings.index("Part 2:\nfindings for chunk 1")
+    assert findings.index("Part 2:\nfindings for chunk 1") < findings.index("Part 3:\nfindings for chunk 2")
+
+
+def test_cached_transcript_is_split_into_segments(extractions, monkeypatch):
+    monkeypatch.setattr(app, "count_tokens", lambda text: len(text.split()))
+    monkeypatch.setattr(app, "map_segment_tokens", 4)
+    findings = asyncio.run(app.FindingsMap(None).gather("One two three. Four five six. Seven."))
+    assert "Part 1:\nfindings for One two three." in findings
+    assert "Part 2:\nfindings for Four five six. Seven." in findings
+
+
+def test_cancel_collects_failed_extractions(extractions):
+    extractions["failing"] = {1}
+    extractions["delays"] = {2: None}
+
+    async def run():
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        findings_map = app.FindingsMap(None)
+        findings_map.add(0, 2, "first")
+        findings_map.add(1, 2, "second")
+        await asyncio.sleep(0.01)
+        await findings_map.cancel()
+        del findings_map
+        gc.collect()
+        return errors
+
+    assert asyncio.run(run()) == []
+    assert extractions["cancelled"] == [2]
+
+
+def test_failed_transcription_cancels_extraction(extractions, monkeypatch, tmp_path):
+    extractions["delays"] = {1: None}
+    monkeypatch.setattr(app, "map_reduce_min_seconds", 1)
+
+    async def transcribe_audio(audio_path, resources, progress=None, on_chunk=None):
+        on_chunk(0, 2, "first chunk")
+        await asyncio.sleep(0.01)
+        raise app.TranscriptionError("chunk 1 failed")
+
+    monkeypatch.setattr(app, "transcribe_audio", transcribe_audio)
+    path = str(tmp_path / "visit.wav")
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(app.speech_sample_rate)
+        wav_file.writeframes(b"\x00\x00" * app.speech_sample_rate * 2)
+
+    with pytest.raises(app.TranscriptionError):
+        asyncio.run(app.generate_soap_note(None, path, ".wav", "none", str(tmp_path), audio_info=app.probe_wav(path)))
+    assert extractions["cancelled"] == [1]
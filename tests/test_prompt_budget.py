@@ -0,0 +1,81 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+sentence = "The dog has been vomiting since Monday."  # 7 words
+
+
+class DirectScheduler:
+    """Stands in for llm_scheduler: runs the call at once, counting calls."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def call(self, func, tokens=0, label="", retryable=None):
+        self.calls += 1
+        return await func()
+
+
+def stub_llm(reply):
+    async def ainvoke(prompt):
+        return SimpleNamespace(content=reply(prompt))
+    return SimpleNamespace(llm=SimpleNamespace(ainvoke=ainvoke))
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    # One token per word keeps budgets readable whatever the tokenizer
+    monkeypatch.setattr(app, "count_tokens", lambda text: len(text.split()))
+    monkeypatch.setattr(app, "template_tokens", lambda: 100)
+    monkeypatch.setattr(app, "soap_prompt_budget", 200 + 100)
+    monkeypatch.setattr(app, "condense_segment_tokens", 70)
+    monkeypatch.setattr(app, "condense_passes", 2)
+    monkeypatch.setattr(app, "note_cache", app.ResultCache("notes", 0))
+    scheduler = DirectScheduler()
+    monkeypatch.setattr(app, "llm_scheduler", scheduler)
+    return scheduler
+
+
+def fit(translation, resources, events=None):
+    events = [] if events is None else events
+    full_text = asyncio.run(
+        app.fit_to_budget("none", translation, resources, lambda event, data: events.append((event, data)))
+    )
+    return full_text, events
+
+
+def test_transcript_within_budget_is_unchanged(scheduler):
+    translation = " ".join([sentence] * 10)
+    full_text, events = fit(translation, stub_llm(lambda prompt: "unused"))
+    assert full_text.endswith("Conversation: " + translation)
+    assert scheduler.calls == 0
+    assert [event for event, _ in events] == ["tokens"]
+    assert events[0][1]["condense_passes"] == 0
+
+
+def test_long_transcript_is_condensed_once(scheduler):
+    translation = " ".join([sentence] * 60)  # 420 words in 6 segments of 70
+    full_text, events = fit(translation, stub_llm(lambda prompt: "Vomiting since Monday."))
+    assert full_text.endswith("Conversation: " + " ".join(["Vomiting since Monday."] * 6))
+    assert scheduler.calls == 6
+    assert [event for event, _ in events] == ["condensing", "tokens"]
+    assert events[1][1]["condense_passes"] == 1
+
+
+def test_transcript_that_will_not_shrink_is_rejected(scheduler):
+    translation = " ".join([sentence] * 60)
+    events = []
+    # The model echoes its whole prompt, so every pass makes things worse
+    with pytest.raises(app.PromptTooLongError):
+        fit(translation, stub_llm(lambda prompt: prompt), events)
+    assert [event for event, _ in events] == ["condensing"] * app.condense_passes
+
+
+def test_history_that_fills_the_budget_is_rejected(scheduler, monkeypatch):
+    monkeypatch.setattr(app, "soap_prompt_budget", 100)
+    with pytest.raises(app.PromptTooLongError):
+        fit(sentence, stub_llm(lambda prompt: "unused"))
+    assert scheduler.calls == 0
@@ -0,0 +1,140 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+import app
+
+
+def status_error(error_class, status_code, headers=None):
+    response = httpx.Response(status_code, headers=headers, request=httpx.Request("POST", "https://api.openai.test"))
+    return error_class("upstream error", response=response, body=None)
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(app, "openai_retry_delay", 0.001)
+    monkeypatch.setattr(app, "openai_retry_max_delay", 0.001)
+    monkeypatch.setattr(app, "state", app.MemoryStateBackend())
+
+
+def test_breaker_opens_after_threshold():
+    breaker = app.CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.check() is False
+    breaker.record_failure()
+    with pytest.raises(app.UpstreamUnavailableError):
+        breaker.check()
+    assert breaker.retry_after() > 0
+
+
+def test_breaker_success_resets_failure_count():
+    breaker = app.CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.check() is False
+
+
+def test_breaker_lets_one_probe_through_after_reset():
+    breaker = app.CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    breaker.opened_at -= 30
+    assert breaker.check() is True
+    with pytest.raises(app.UpstreamUnavailableError):
+        breaker.check()
+    breaker.record_success()
+    assert breaker.check() is False
+
+
+def test_failed_probe_opens_breaker_again():
+    breaker = app.CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        breaker.record_failure()
+    breaker.opened_at -= 30
+    assert breaker.check() is True
+    breaker.record_failure()
+    with pytest.raises(app.UpstreamUnavailableError):
+        breaker.check()
+    assert breaker.retry_after() > 29
+
+
+def test_released_probe_lets_next_call_probe():
+    breaker = app.CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    breaker.opened_at -= 30
+    assert breaker.check() is True
+    breaker.release()
+    assert breaker.check() is True
+
+
+def test_only_outages_count_towards_breaker():
+    assert app.is_outage(status_error(openai.InternalServerError, 503))
+    assert app.is_outage(openai.APITimeoutError(httpx.Request("POST", "https://api.openai.test")))
+    assert not app.is_outage(status_error(openai.RateLimitError, 429))
+    assert not app.is_outage(status_error(openai.BadRequestError, 400))
+
+
+def test_retry_after_prefers_milliseconds_header():
+    assert app.retry_after_seconds(status_error(openai.RateLimitError, 429, {"retry-after-ms": "250"})) == 0.25
+    assert app.retry_after_seconds(status_error(openai.RateLimitError, 429, {"retry-after": "2"})) == 2
+    assert app.retry_after_seconds(status_error(openai.RateLimitError, 429)) == 0
+
+
+def test_rate_limit_burst_does_not_trip_breaker(fast_retries):
+    scheduler = app.OpenAIScheduler("test", concurrency=40, rpm=6000)
+    scheduler.breaker.failure_threshold = 5
+    rate_limited = 40
+
+    async def call():
+        nonlocal rate_limited
+        if rate_limited:
+            rate_limited -= 1
+            raise status_error(openai.RateLimitError, 429, {"retry-after-ms": "20"})
+        return "ok"
+
+    async def burst():
+        return await asyncio.gather(*(scheduler.call(call) for _ in range(40)))
+
+    assert asyncio.run(burst()) == ["ok"] * 40
+    assert scheduler.breaker.opened_at is None
+
+
+def test_rate_limit_pauses_bucket_for_every_caller(fast_retries):
+    scheduler = app.OpenAIScheduler("test", concurrency=4, rpm=6000)
+    asyncio.run(scheduler.pause(0.2))
+
+    async def acquire():
+        return await scheduler.requests.acquire(1)
+
+    assert asyncio.run(acquire()) >= 0.15
+
+
+def test_breaker_opening_mid_retry_does_not_abort_call(fast_retries):
+    scheduler = app.OpenAIScheduler("test", concurrency=1, rpm=0)
+    scheduler.breaker.failure_threshold = 1
+    failures = 2
+
+    async def call():
+        nonlocal failures
+        if failures:
+            failures -= 1
+            raise status_error(openai.InternalServerError, 500)
+        return "ok"
+
+    assert asyncio.run(scheduler.call(call)) == "ok"
+    assert scheduler.breaker.opened_at is None
+
+
+def test_open_breaker_rejects_new_calls(fast_retries):
+    scheduler = app.OpenAIScheduler("test", concurrency=1, rpm=0)
+    scheduler.breaker.failure_threshold = 1
+    scheduler.breaker.record_failure()
+
+    async def call():
+        return "ok"
+
+    with pytest.raises(app.UpstreamUnavailableError):
+        asyncio.run(scheduler.call(call))
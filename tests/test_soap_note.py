@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+import app
+
+note_text = """Subjective: Owner reports two days of vomiting.
+
+The dog is still drinking water.
+Objective: Temperature 39.4 C.
+Assessment: Acute gastroenteritis.
+Plan: Bland diet for five days.
+Conclusion: Outpatient management.
+Differentialdiagnosis: Gastroenterology-Gastroenteritis
+Preventive Measures:
+- Vaccinations: Rabies, 01-12-2026
+- Deworming: Praziquantel, 15-11-2026
+Prescription:
+Name: Maropitant
+Duration: 3 days
+Dosage: 1 mg/kg
+Frequency: Morning
+Remarks: After meal
+Diet Recommendations: Boiled chicken and rice.
+Diagnostic Tests: CBC, 20-10-2026
+"""
+
+
+def test_free_text_sections():
+    note = app.parse_soap_note(note_text)
+    assert note["Subjective"] == "Owner reports two days of vomiting.\n\nThe dog is still drinking water."
+    assert note["Objective"] == "Temperature 39.4 C."
+    assert note["Plan"] == "Bland diet for five days."
+    assert note["DifferentialDiagnosis"] == "Gastroenterology-Gastroenteritis"
+
+
+def test_prompt_headings_start_their_own_sections():
+    note = app.parse_soap_note(note_text)
+    assert note["Preventive"] == [
+        {"Type": "Vaccination", "Name": "Rabies", "Date": "01-12-2026"},
+        {"Type": "Deworming", "Name": "Praziquantel", "Date": "15-11-2026"},
+    ]
+    assert note["Dietrecommendations"] == ["Boiled chicken and rice."]
+    assert note["Diagnostics"] == [{"Name": "CBC", "Date": "20-10-2026"}]
+
+
+def test_prescription_fields_grouped_by_name():
+    text = "Prescription:\nName: Maropitant\nDosage: 1 mg/kg\nName: Omeprazole\nFrequency: Night\n"
+    assert app.parse_soap_note(text)["Prescription"] == [
+        {"Name": "Maropitant", "Duration": "", "Dosage": "1 mg/kg", "Frequency": "", "Remarks": ""},
+        {"Name": "Omeprazole", "Duration": "", "Dosage": "", "Frequency": "Night", "Remarks": ""},
+    ]
+
+
+def test_placeholder_items_are_dropped():
+    note = app.parse_soap_note("Plan: Recheck.\nDiagnostics: None\nDietrecommendations: N/A\n")
+    assert note["Diagnostics"] == []
+    assert note["Dietrecommendations"] == []
+
+
+def test_streamed_pieces_match_whole_text():
+    parser = app.SoapSectionParser()
+    sections = []
+    for start in range(0, len(note_text), 7):
+        sections += parser.feed(note_text[start:start + 7])
+    sections += parser.close()
+    whole = app.SoapSectionParser()
+    assert sections == whole.feed(note_text) + whole.close()
+
+
+def test_structured_output_used_directly():
+    structured = {
+        "Subjective": " Vomiting. ",
+        "DifferentialDiagnosis": "Gastroenterology-Gastroenteritis",
+        "Diagnostics": [{"Name": "CBC", "Date": "20-10-2026"}],
+    }
+    note = app.parse_soap_note(json.dumps(structured))
+    assert note["Subjective"] == "Vomiting."
+    assert note["Diagnostics"] == [{"Name": "CBC", "Date": "20-10-2026"}]
+    assert note["Plan"] == ""
+
+
+def test_malformed_function_call_json_is_salvaged():
+    # Cut off at the token limit, with a raw newline inside a string
+    text = '{"Subjective": "Vomiting\nfor two days.", "Objective": "Temp 39.4 C", "Assessment": "Acute gastro'
+    note = app.parse_soap_note(text)
+    assert note["Subjective"] == "Vomiting\nfor two days."
+    assert note["Objective"] == "Temp 39.4 C"
+    assert note["Assessment"] == ""
+
+
+def test_cached_note_is_not_reported_as_model_output(monkeypatch):
+    cache = app.ResultCache("notes", 8)
+    monkeypatch.setattr(app, "note_cache", cache)
+    cached = json.dumps({"Subjective": "Vomiting for two days."})
+    asyncio.run(cache.set(app.note_cache_key("transcript"), cached))
+    events = []
+
+    note = asyncio.run(app.write_soap_note("transcript", None, lambda event, data: events.append(event)))
+    assert note == cached
+    assert events == ["note_cached"]
@@ -0,0 +1,93 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = app.SqliteStateBackend(str(tmp_path / "state.db"))
+    yield backend
+    backend.close()
+
+
+def test_entries_round_trip_and_expire(backend):
+    async def run():
+        await backend.set("jobs", "a", {"status": "queued"})
+        await backend.set("jobs", "b", "gone", ttl=-1)
+        return await backend.get("jobs", "a"), await backend.get("jobs", "b")
+
+    assert asyncio.run(run()) == ({"status": "queued"}, None)
+
+
+def test_drained_bucket_makes_callers_wait(backend):
+    async def run():
+        assert await backend.take("requests", 1, 60) == 0
+        await backend.drain("requests", 2, 60)
+        return await backend.take("requests", 1, 60)
+
+    assert asyncio.run(run()) > 2
+
+
+def test_locked_database_does_not_stall_event_loop(backend):
+    # A sibling worker holds the write lock for a while
+    other = sqlite3.connect(backend.path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.5, other.execute, ["COMMIT"]).start()
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        started = time.monotonic()
+        await backend.take("requests", 1, 60)
+        ticker.cancel()
+        return ticks, time.monotonic() - started
+
+    ticks, elapsed = asyncio.run(run())
+    other.close()
+    assert elapsed >= 0.4
+    assert ticks >= 10
+
+
+def test_locked_database_is_retried(backend, monkeypatch):
+    calls = 0
+
+    def flaky_get(namespace, key):
+        nonlocal calls
+        calls += 1
+        if calls < app.state_attempts:
+            raise sqlite3.OperationalError("database is locked")
+        return "value"
+
+    monkeypatch.setattr(backend, "_get", flaky_get)
+    assert asyncio.run(backend.get("entries", "key")) == "value"
+    assert calls == app.state_attempts
+
+
+def test_cache_treats_unreadable_state_as_miss(backend, monkeypatch):
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(app, "state", backend)
+    monkeypatch.setattr(backend, "_get", locked)
+    monkeypatch.setattr(backend, "_set", locked)
+    monkeypatch.setattr(app, "state_attempts", 1)
+    cache = app.ResultCache("test", 8)
+
+    async def run():
+        miss = await cache.get("key")
+        await cache.set("key", "value")
+        return miss, await cache.get("key")
+
+    assert asyncio.run(run()) == (None, "value")